@@ -0,0 +1,99 @@
+"""Microbenchmark of one top_p sampling step, sorting the whole vocabulary or not.
+
+Run from the repository root:
+    python -m generator.gpt2.bench_sampling
+    python -m generator.gpt2.bench_sampling --backend numpy --batch 4
+
+The logits are synthetic, drawn to be as peaked as a language model's at the given
+temperature, so no model needs to be loaded.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+
+def synthetic_logits(rng, steps, batch, n_vocab, temperature):
+    # Zipf-like token frequencies plus noise roughly match GPT-2's logit distribution
+    ranks = np.log(np.arange(1, n_vocab + 1, dtype=np.float32))
+    logits = -1.5 * ranks + rng.standard_normal((steps, batch, n_vocab)).astype(np.float32)
+    for step in logits:
+        for row in step:
+            rng.shuffle(row)
+    return logits / np.float32(temperature)
+
+
+def numpy_step(top_p, candidates):
+    from generator.gpt2.src import np_sample
+
+    rng = np.random.RandomState(0)
+
+    def run(logits):
+        logits = np_sample.top_p_logits(logits, p=top_p, candidates=candidates)
+        return np_sample.multinomial(logits, rng), logits > -1e10
+
+    return run
+
+
+def tensorflow_step(top_p, candidates, batch, n_vocab):
+    import tensorflow as tf
+    from generator.gpt2.src import sample
+
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    logits_ph = tf.placeholder(tf.float32, [batch, n_vocab])
+    logits = sample.top_p_logits(logits_ph, p=top_p, candidates=candidates)
+    samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+    sess = tf.compat.v1.Session()
+
+    def run(step_logits):
+        out, kept = sess.run([samples, logits > -1e10], feed_dict={logits_ph: step_logits})
+        return out[:, 0], kept
+
+    return run
+
+
+def benchmark(run, logits):
+    run(logits[0])  # warm up
+    kept = []
+    start = time.time()
+    for step_logits in logits:
+        kept.append(run(step_logits)[1])
+    return (time.time() - start) / len(logits), np.stack(kept)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time top_p sampling per decoding step.")
+    parser.add_argument("--backend", choices=("tensorflow", "numpy"), default="tensorflow")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--n_vocab", type=int, default=50257)
+    parser.add_argument("--temperature", type=float, default=0.4)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--candidates", type=int, default=512)
+    args = parser.parse_args()
+
+    logits = synthetic_logits(
+        np.random.RandomState(0), args.steps, args.batch, args.n_vocab, args.temperature
+    )
+    if args.backend == "numpy":
+        exact_step = numpy_step(args.top_p, 0)
+        bounded_step = numpy_step(args.top_p, args.candidates)
+    else:
+        exact_step = tensorflow_step(args.top_p, 0, args.batch, args.n_vocab)
+        bounded_step = tensorflow_step(args.top_p, args.candidates, args.batch, args.n_vocab)
+
+    exact_time, exact_kept = benchmark(exact_step, logits)
+    bounded_time, bounded_kept = benchmark(bounded_step, logits)
+    nucleus = exact_kept.sum(axis=-1)
+
+    print("{} steps of batch {} on the {} backend".format(args.steps, args.batch, args.backend))
+    print("nucleus size:        median {:.0f}, max {}".format(np.median(nucleus), nucleus.max()))
+    print("fits in candidates:  {:.1%}".format((nucleus <= args.candidates).mean()))
+    print("full sort:           {:.3f} ms/step".format(exact_time * 1000))
+    print("top {} first:       {:.3f} ms/step".format(args.candidates, bounded_time * 1000))
+    print("same nucleus:        {:.1%}".format((exact_kept == bounded_kept).all(axis=-1).mean()))
+
+
+if __name__ == "__main__":
+    main()
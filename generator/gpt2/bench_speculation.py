@@ -0,0 +1,118 @@
+"""Acceptance rate and speed of speculative decoding on the turns of saved games.
+
+Run from the repository root:
+    python -m generator.gpt2.bench_speculation model_v5
+    python -m generator.gpt2.bench_speculation model_v5 --draft_model 124M
+
+Every turn of every unencrypted save in --saves is sampled from the prompt the game
+would have built for it, once with the plain numpy sampling loop and once with
+drafts (copied from the prompt, or from --draft_model), with the same settings.
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from generator.gpt2.gpt2_generator import GPT2Generator
+from generator.gpt2.src import np_model, np_sample
+from story.story_manager import Story, save_path
+
+
+def turn_prompts(generator, story):
+    """The prompt of every action in story, as play.py would have built it."""
+    for turn in range(len(story.actions)):
+        earlier = copy.copy(story)
+        earlier.actions = story.actions[:turn]
+        earlier.results = story.results[:turn]
+        pinned, blocks = earlier.context_blocks()
+        yield generator.build_prompt(pinned, blocks + [story.actions[turn]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare plain and speculative sampling.")
+    parser.add_argument("model_name", nargs="?", default="model_v5")
+    parser.add_argument("--saves", default=save_path)
+    parser.add_argument("--turns", type=int, default=50, help="stop after this many turns")
+    parser.add_argument("--length", type=int, default=60)
+    parser.add_argument("--quantization", default=None)
+    parser.add_argument("--draft_model", default=None)
+    parser.add_argument("--draft_tokens", type=int, default=4)
+    args = parser.parse_args()
+
+    generator = GPT2Generator(
+        model_name=args.model_name,
+        quantization=args.quantization,
+        backend="numpy",
+        generate_num=args.length,
+        draft_model=args.draft_model,
+        draft_tokens=args.draft_tokens,
+        prompt_lookup=args.draft_model is None,
+    )
+    backend = generator.backend
+    settings = generator.sampling_settings()
+    del settings["deadline"]
+    past = np.zeros(
+        np_model.past_shape(hparams=generator.hparams, batch_size=1, sequence=0),
+        dtype=np.float32,
+    )
+
+    prompts = []
+    for path in sorted(glob.glob(os.path.join(args.saves, "story*.json"))):
+        story = Story("")
+        with open(path) as f:
+            story.init_from_dict(json.load(f))
+        prompts.extend(turn_prompts(generator, story))
+    prompts = prompts[: args.turns]
+    if len(prompts) == 0:
+        print("No unencrypted saves with actions in " + args.saves)
+        return
+
+    plain_time = speculative_time = 0
+    plain_tokens = speculative_tokens = drafted = accepted = 0
+    for prompt in prompts:
+        context = np.array([generator.fit_context(generator.prompt_replace(prompt))])
+
+        start = time.time()
+        results = np_sample.sample_sequence(
+            hparams=generator.hparams,
+            weights=backend.weights,
+            context=context,
+            sentence_tokens=generator.sentence_tokens,
+            end_token=generator.end_token,
+            rng=backend.rng,
+            **settings
+        )
+        plain_time += time.time() - start
+        plain_tokens += results["tokens"].shape[1] - context.shape[1]
+
+        start = time.time()
+        results = backend.sample(
+            context, past, context[:, :0], keep_past=False, **settings
+        )
+        speculative_time += time.time() - start
+        speculative_tokens += results["tokens"].shape[1] - context.shape[1]
+        drafted += results["drafted"]
+        accepted += results["accepted"]
+
+    plain_speed = plain_tokens / plain_time
+    speculative_speed = speculative_tokens / speculative_time
+    print(
+        "{} turns, up to {} tokens each, drafts {}".format(
+            len(prompts),
+            args.length,
+            "from " + args.draft_model if args.draft_model else "copied from the prompt",
+        )
+    )
+    print("drafted tokens:   {}".format(drafted))
+    print("acceptance rate:  {:.1%}".format(accepted / max(drafted, 1)))
+    print("plain:            {:.2f} tokens/s".format(plain_speed))
+    print("speculative:      {:.2f} tokens/s".format(speculative_speed))
+    print("speedup:          {:.2f}x".format(speculative_speed / plain_speed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Export a model checkpoint to a memory-mappable weights file.
+
+Run from the repository root, e.g.: python -m generator.gpt2.export_weights model_v5
+
+GPT2Generator maps generator/gpt2/models/<model>/model.weights instead of restoring
+the checkpoint whenever it was exported from the model's latest checkpoint.
+"""
+
+import os
+import sys
+
+import tensorflow as tf
+from generator.gpt2.src import weights
+
+models_dir = "generator/gpt2/models"
+
+
+def export(model_name):
+    checkpoint = tf.train.latest_checkpoint(os.path.join(models_dir, model_name))
+    if checkpoint is None:
+        raise FileNotFoundError("No checkpoint found for " + model_name)
+    reader = tf.train.load_checkpoint(checkpoint)
+    arrays = {
+        name: reader.get_tensor(name)
+        for name in reader.get_variable_to_shape_map()
+        # Leave out optimizer slots saved by fine-tuning
+        if name.startswith("model/") and name.split("/")[-1] in ("w", "b", "g", "wte", "wpe")
+    }
+    path = os.path.join(models_dir, model_name, weights.WEIGHTS_FILE)
+    weights.save(path, arrays, {"checkpoint": weights.checkpoint_name(checkpoint)})
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("You must enter the model name as a parameter, e.g.: python -m generator.gpt2.export_weights model_v5")
+        sys.exit(1)
+    print("Wrote " + export(sys.argv[1]))
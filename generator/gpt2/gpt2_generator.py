@@ -1,47 +1,114 @@
 import json
 import os
 import warnings
+from collections import OrderedDict
 
 import numpy as np
-import tensorflow as tf
-from generator.gpt2.src import encoder, model, sample
+from generator.gpt2.prefix_cache import PrefixCache
+from generator.gpt2.src import encoder, np_model
 from story.utils import *
 
 warnings.filterwarnings("ignore")
 
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+BACKENDS = ("tensorflow", "numpy")
+# Printed by generate(on_text=...) before a result that differs from what was streamed
+REPLACED_MARKER = "[Corrected:]"
 
 
 class GPT2Generator:
-    def __init__(self, generate_num=80, temperature=0.4, top_p=0.9, censor=False, raw=False, model_name="model_v5"):
+    def __init__(self, generate_num=80, temperature=0.4, top_p=0.9, censor=False, raw=False, model_name="model_v5", candidates=1, quantization=None, backend="tensorflow", draft_model=None, draft_tokens=4, prompt_lookup=False, cache_mb=None):
         self.generate_num = generate_num
         self.default_gen_num = generate_num
         self.temp = temperature
         #self.top_k = top_k
         self.top_p = top_p
+        self.penalty = 0.85
+        # Only penalize tokens used in the last this many (0 for the whole context)
+        self.penalty_window = 0
+        # top_p looks for the nucleus among this many of the most likely tokens before
+        # sorting the whole vocabulary (0 to always sort it)
+        self.nucleus_candidates = 512
+        # Stop sampling after this many complete sentences (0 for no limit)
+        self.max_sentences = 0
         self.censor = censor
         self.raw = raw
         self.model_name = model_name
         self.model_dir = "generator/gpt2/models"
         self.model_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
 
-        self.batch_size = 1
-        self.samples = 1
+        # Continuations sampled side by side in one batched run; generate() keeps the
+        # first one that passes its checks instead of retrying serially.
+        self.candidates = candidates
+        # Tokens sampled per backend call when streaming
+        self.stream_chunk = 4
+        # time.time() after which sampling stops with a TimeoutError (None for no limit),
+        # set by StoryManager.with_deadline
+        self.deadline = None
 
         self.enc = encoder.get_encoder(self.model_name, self.model_dir)
+        self.hparams = np_model.default_hparams()
+        with open(os.path.join(self.model_dir, self.model_name, "hparams.json")) as f:
+            self.hparams.override_from_dict(json.load(f))
 
-        config = tf.compat.v1.ConfigProto()
-        config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
+        # Keys/values of recent prompts, so a prompt only has to run the model over
+        # the text after the longest prefix it shares with one of them (the last
+        # turn's prompt, or the opening of an earlier game). cache_mb (or
+        # AIDUNGEON_CACHE_MB) caps them in MiB; by default there's room for one full
+        # context, which is what a single game's next turn needs.
+        if cache_mb is None and os.environ.get("AIDUNGEON_CACHE_MB"):
+            cache_mb = int(os.environ["AIDUNGEON_CACHE_MB"])
+        if cache_mb is None:
+            context_shape = np_model.past_shape(
+                hparams=self.hparams, batch_size=1, sequence=self.hparams.n_ctx
+            )
+            max_bytes = int(np.prod(context_shape)) * np.dtype(np.float32).itemsize
+        else:
+            max_bytes = cache_mb << 20
+        self.prefix_cache = PrefixCache(max_bytes=max_bytes)
+        # Token counts of recently used story blocks, for build_prompt
+        self.block_lengths = OrderedDict()
+
+        # cut_trailing_sentence throws away everything from the first "<" (and ">" unless
+        # raw), so sampling stops as soon as one of those is produced.
+        self.end_token = self.enc.encoder["<|endoftext|>"]
+        self.stop_tokens = self.token_mask("<>")
+        self.raw_stop_tokens = self.token_mask("<")
+        self.sentence_tokens = self.token_mask(".!?")
 
-        self.context = tf.placeholder(tf.int32, [self.batch_size, None])
-        # np.random.seed(seed)
-        # tf.set_random_seed(seed)
-        self.gen_output()
+        self.quantization = quantization
+        # Smaller model with the same vocabulary that drafts draft_tokens tokens at a
+        # time for the model to check at once (numpy backend only)
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens
+        # Draft by copying what followed the last few tokens earlier in the prompt
+        # instead (numpy backend only)
+        self.prompt_lookup = prompt_lookup
+        self.backend = self.load_backend(backend, quantization)
 
-        self.saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(self.model_dir, self.model_name))
-        self.saver.restore(self.sess, ckpt)
+    def load_backend(self, backend, quantization):
+        # The numpy backend runs on exported weights (see export_weights.py) and doesn't
+        # need TensorFlow installed, so each backend is only imported when chosen.
+        if backend == "tensorflow":
+            from generator.gpt2.tf_backend import TFBackend as Backend
+        elif backend == "numpy":
+            from generator.gpt2.np_backend import NumpyBackend as Backend
+        else:
+            raise ValueError("backend must be one of " + ", ".join(BACKENDS))
+        settings = {}
+        if self.draft_model is not None or self.prompt_lookup:
+            if backend != "numpy":
+                raise ValueError("Speculative decoding needs the numpy backend")
+            settings.update(draft_tokens=self.draft_tokens, prompt_lookup=self.prompt_lookup)
+        if self.draft_model is not None:
+            settings.update(draft_path=os.path.join(self.model_dir, self.draft_model))
+        return Backend(
+            self.hparams,
+            os.path.join(self.model_dir, self.model_name),
+            quantization=quantization,
+            sentence_tokens=self.sentence_tokens,
+            end_token=self.end_token,
+            **settings
+        )
 
     def prompt_replace(self, prompt):
         # print("\n\nBEFORE PROMPT_REPLACE:")
@@ -81,47 +148,334 @@ class GPT2Generator:
         return result
 
     def generate_raw(self, prompt):
-        while len(prompt) > 3500:
-            prompt = self.cut_down_prompt(prompt)
+        return self.generate_raw_batch(prompt, 1)[0]
+
+    def context_budget(self):
+        """Number of prompt tokens that leave room in n_ctx for the generated ones."""
+        return self.hparams.n_ctx - self.generate_num
+
+    def block_length(self, block):
+        if block in self.block_lengths:
+            self.block_lengths.move_to_end(block)
+        else:
+            self.block_lengths[block] = len(self.enc.encode(block, incremental=False))
+            if len(self.block_lengths) > 256:
+                self.block_lengths.popitem(last=False)
+        return self.block_lengths[block]
+
+    def build_prompt(self, pinned, blocks):
+        """Join pinned text and as many of the newest blocks as fit in the context.
+
+        Token counts are cached per block, so a turn only encodes the blocks added since
+        the previous one. Counts can be off by a token at block boundaries;
+        prepare_context trims whatever still doesn't fit.
+        """
+        budget = self.context_budget() - self.block_length(pinned)
+        start = len(blocks)
+        while start > 0 and self.block_length(blocks[start - 1]) <= budget:
+            start -= 1
+            budget -= self.block_length(blocks[start])
+        return pinned + "".join(blocks[start:])
+
+    def fit_context(self, prompt):
+        """Encode prompt, cutting it down until it fits in the context budget."""
+        budget = self.context_budget()
         context_tokens = self.enc.encode(prompt)
-        generated = 0
-        for _ in range(self.samples // self.batch_size):
-            out = self.sess.run(
-                self.output,
-                feed_dict={
-                    self.context: [context_tokens for _ in range(self.batch_size)]
-                },
-            )[:, len(context_tokens) :]
-            for i in range(self.batch_size):
-                generated += 1
-                text = self.enc.decode(out[i])
-        return text
-
-    def generate(self, prompt, options=None, seed=1, depth=1):
+        while len(context_tokens) > budget:
+            cut_prompt = self.cut_down_prompt(prompt)
+            if cut_prompt == prompt:
+                return context_tokens[-budget:]
+            prompt = cut_prompt
+            context_tokens = self.enc.encode(prompt)
+        return context_tokens
+
+    def prepare_context(self, prompt):
+        """Encode prompt and look up how much of it is already in the cache.
+
+        Returns the prompt tokens, the number of them covered by the cached past, and
+        that past for a batch of one.
+        """
+        context_tokens = self.fit_context(prompt)
+        # At least one token is always left to run so there are logits to sample from
+        reused, past = self.prefix_cache.lookup(context_tokens[:-1])
+        if reused == 0:
+            past = np.zeros(
+                np_model.past_shape(hparams=self.hparams, batch_size=1, sequence=0),
+                dtype=np.float32,
+            )
+        return context_tokens, reused, past
+
+    def generate_raw_batch(self, prompt, batch_size):
+        context_tokens, reused, past = self.prepare_context(prompt)
+        new_tokens = context_tokens[reused:]
+        results = self.backend.sample(
+            [new_tokens for _ in range(batch_size)],
+            np.repeat(past, batch_size, axis=0),
+            [context_tokens[:reused] for _ in range(batch_size)],
+            keep_past=False,
+            **self.sampling_settings(),
+        )
+        out = results["tokens"][:, len(new_tokens) :]
+        self.prefix_cache.insert(context_tokens, results["context_past"][:1])
+        return [self.enc.decode(out[i]) for i in range(batch_size)]
+
+    def prefill(self, prompt):
+        """Run the model over prompt only to put its keys/values in the prefix cache.
+
+        For text a later prompt is expected to start with, so generating from that one
+        only has to run the model over what it adds.
+        """
+        context_tokens = self.fit_context(self.prompt_replace(prompt))
+        reused, past = self.prefix_cache.lookup(context_tokens)
+        if reused == len(context_tokens):
+            return
+        if reused == 0:
+            past = np.zeros(
+                np_model.past_shape(hparams=self.hparams, batch_size=1, sequence=0),
+                dtype=np.float32,
+            )
+        settings = self.sampling_settings()
+        settings.update(length=1)
+        results = self.backend.sample(
+            [context_tokens[reused:]],
+            past,
+            [context_tokens[:reused]],
+            keep_past=False,
+            **settings
+        )
+        self.prefix_cache.insert(context_tokens, results["context_past"])
+
+    def stream_raw(self, prompt):
+        """Yield the decoded text of one continuation of prompt as it is sampled.
+
+        The sampling loop runs stream_chunk tokens per backend call and the keys/values
+        of everything sampled so far are fed back in, so each run only processes the
+        tokens it adds.
+        """
+        context_tokens, reused, past = self.prepare_context(prompt)
+        feed_tokens = context_tokens[reused:]
+        past_tokens = context_tokens[:reused]
+        stop_tokens = self.raw_stop_tokens if self.raw else self.stop_tokens
+        generated = []
+        decoder = self.enc.incremental_decoder()
+        while len(generated) < self.generate_num:
+            max_sentences = 0
+            if self.max_sentences > 0:
+                max_sentences = self.max_sentences - int(self.sentence_tokens[generated].sum())
+                if max_sentences <= 0:
+                    break
+            settings = self.sampling_settings()
+            settings.update(
+                length=min(self.stream_chunk, self.generate_num - len(generated)),
+                max_sentences=max_sentences,
+            )
+            results = self.backend.sample(
+                [feed_tokens],
+                past,
+                [past_tokens],
+                context_past=len(generated) == 0,
+                **settings
+            )
+            past = results["past"]
+            if len(generated) == 0:
+                self.prefix_cache.insert(context_tokens, results["context_past"])
+
+            sampled = results["tokens"][0, len(feed_tokens) :].tolist()
+            generated.extend(sampled)
+            yield decoder.decode(sampled)
+            if stop_tokens[sampled].any():
+                break
+
+            # past now covers everything but the last sampled token
+            past_tokens = context_tokens + generated[:-1]
+            feed_tokens = generated[-1:]
+        yield decoder.flush()
+
+    def stream_raw_batch(self, prompt, batch_size):
+        """Like stream_raw, for batch_size continuations sampled side by side.
+
+        Yields the new text of every row after each backend call, so a deadline stops
+        the batch within stream_chunk tokens. Rows that stopped are sampled along until
+        every row has, but nothing after their stop is yielded.
+        """
+        context_tokens, reused, past = self.prepare_context(prompt)
+        feed_tokens = np.array([context_tokens[reused:]] * batch_size, dtype=np.int32)
+        past = np.repeat(past, batch_size, axis=0)
+        past_tokens = np.array(
+            [context_tokens[:reused]] * batch_size, dtype=np.int32
+        ).reshape([batch_size, reused])
+        stop_tokens = self.raw_stop_tokens if self.raw else self.stop_tokens
+        generated = [[] for _ in range(batch_size)]
+        finished = [False] * batch_size
+        decoders = [self.enc.incremental_decoder() for _ in range(batch_size)]
+        length = 0
+        while length < self.generate_num and not all(finished):
+            settings = self.sampling_settings()
+            # Each row's sentences are counted below instead
+            settings.update(
+                length=min(self.stream_chunk, self.generate_num - length), max_sentences=0
+            )
+            results = self.backend.sample(
+                feed_tokens, past, past_tokens, context_past=length == 0, **settings
+            )
+            past = results["past"]
+            if length == 0:
+                self.prefix_cache.insert(context_tokens, results["context_past"][:1])
+
+            sampled = results["tokens"][:, feed_tokens.shape[1] :]
+            length += sampled.shape[1]
+            texts = []
+            for i, tokens in enumerate(sampled.tolist()):
+                new = []
+                while not finished[i] and len(new) < len(tokens):
+                    new.append(tokens[len(new)])
+                    finished[i] = bool(stop_tokens[new[-1]])
+                    if self.max_sentences > 0:
+                        sentences = int(self.sentence_tokens[generated[i] + new].sum())
+                        finished[i] |= sentences >= self.max_sentences
+                generated[i].extend(new)
+                texts.append(decoders[i].decode(new))
+            yield texts
+
+            # past now covers everything but the last sampled token of every row
+            tokens = np.concatenate([past_tokens, results["tokens"]], axis=1)
+            past_tokens = tokens[:, :-1]
+            feed_tokens = tokens[:, -1:]
+        yield [decoder.flush() for decoder in decoders]
+
+    def stable_result(self, text, actions):
+        """The part of result_replace(text) that more generated text can't change.
+
+        Only complete sentences outside of quotes are considered, so cutting the
+        trailing sentence and fixing trailing quotes don't touch what is returned.
+        """
+        cut = 0
+        for match in re.finditer(r"[.!?]+\"?(?=\s)", text):
+            if text[: match.end()].count('"') % 2 == 0:
+                cut = match.end()
+        if cut == 0:
+            return ""
+        stable = self.result_replace(text[:cut], actions)
+        # result_replace only removes an echoed action sentence once something follows
+        # it, so one at the end is held back until then
+        held = True
+        while held:
+            held = False
+            for sentence in actions:
+                sentence = sentence.strip()
+                if len(sentence) > 0 and stable.endswith(sentence):
+                    stable = stable[: -len(sentence)].rstrip()
+                    held = True
+        return stable
+
+    def sampling_settings(self):
+        return {
+            "length": self.generate_num,
+            "temperature": self.temp,
+            "top_p": self.top_p,
+            "penalty": self.penalty,
+            "penalty_window": self.penalty_window,
+            "nucleus_candidates": self.nucleus_candidates,
+            "max_sentences": self.max_sentences,
+            "stop_tokens": self.raw_stop_tokens if self.raw else self.stop_tokens,
+            "deadline": self.deadline,
+        }
+
+    def token_mask(self, chars):
+        """Boolean mask over the vocabulary of tokens containing any of chars."""
+        mask = np.zeros(self.hparams.n_vocab, dtype=bool)
+        mask[self.enc.tokens_containing(chars)] = True
+        return mask
+
+    def clear_cache(self):
+        self.prefix_cache.clear()
+
+    def generate(self, prompt, options=None, seed=1, depth=1, reject=None, on_text=None):
+        """Generate the next story block for prompt.
+
+        When more than one candidate is sampled, the first one that survives
+        result_replace, has at least two sentences and isn't refused by reject is used.
+        If on_text is given it is called with the result piece by piece; with a single
+        candidate this happens while it is being sampled, one sentence at a time.
+        """
 
         debug_print = False
         prompt = self.prompt_replace(prompt)
-        last_prompt = prompt[prompt.rfind(">")+2:] if prompt.rfind(">") > -1 else prompt
 
         if debug_print:
             print("******DEBUG******")
             print("Prompt is: ", repr(prompt))
 
-        text = self.generate_raw(prompt)
+        actions = self.prompt_actions(prompt)
+        shown = ""
+        if on_text is not None and self.candidates == 1:
+            text = ""
+            for chunk in self.stream_raw(prompt):
+                text += chunk
+                stable = self.stable_result(text, actions)
+                if len(stable) > len(shown) and stable.startswith(shown):
+                    on_text(stable[len(shown) :])
+                    shown = stable
+            texts = [text]
+        else:
+            texts = self.generate_raw_batch(prompt, self.candidates)
 
         if debug_print:
-            print("Generated result is: ", repr(text))
+            print("Generated results are: ", repr(texts))
             print("******END DEBUG******")
 
-        result = text
-        result = self.result_replace(result, re.findall(r".+?(?:\.{1,3}|[!\?]|$)(?!\")", last_prompt))
-        if len(result) == 0 and depth < 20:
-            return self.generate(self.cut_down_prompt(prompt), depth=depth+1)
-        elif result.count(".") < 2 and depth < 20:
-            return self.generate(prompt, depth=depth+1)
+        results = [self.result_replace(text, actions) for text in texts]
+        usable = [result for result in results if self.usable(result)]
+        good = [result for result in usable if reject is None or not reject(result)]
+
+        result = results[0]
+        if len(good) > 0:
+            result = good[0]
+        elif len(usable) > 0:
+            result = usable[0]
+        elif len(shown) > 0 or depth >= 20:
+            # Part of the result is already on screen, so there's no retrying it
+            pass
+        elif len(result) == 0:
+            return self.generate(self.cut_down_prompt(prompt), depth=depth+1, reject=reject, on_text=on_text)
+        else:
+            return self.generate(prompt, depth=depth+1, reject=reject, on_text=on_text)
 
+        if on_text is not None:
+            if result.startswith(shown):
+                on_text(result[len(shown) :])
+            else:
+                # Cleaning up the whole text changed some that is already on screen and
+                # can't be taken back, so the result that is kept follows, marked
+                on_text("\n" + REPLACED_MARKER + "\n" + result)
         return result
 
+    def generate_many(self, prompt, count, reject=None):
+        """Up to count results for prompt, sampled as one batch.
+
+        The batch is streamed, so an expired deadline interrupts it between backend
+        calls. Results generate() would have retried or rejected are left out.
+        """
+        prompt = self.prompt_replace(prompt)
+        actions = self.prompt_actions(prompt)
+        texts = [""] * count
+        for chunks in self.stream_raw_batch(prompt, count):
+            texts = [text + chunk for text, chunk in zip(texts, chunks)]
+        results = [self.result_replace(text, actions) for text in texts]
+        return [
+            result
+            for result in results
+            if self.usable(result) and (reject is None or not reject(result))
+        ]
+
+    def prompt_actions(self, prompt):
+        """Sentences of the last action in prompt, for result_replace."""
+        last_prompt = prompt[prompt.rfind(">")+2:] if prompt.rfind(">") > -1 else prompt
+        return re.findall(r".+?(?:\.{1,3}|[!\?]|$)(?!\")", last_prompt)
+
+    def usable(self, result):
+        return len(result) > 0 and result.count(".") >= 2
+
     def cut_down_prompt(self, prompt):
         if not self.raw:
             split_prompt = prompt.split(">")
@@ -138,22 +492,6 @@ class GPT2Generator:
                     new_text = new_text + " " + sentences[i]
             return new_text.lstrip()
 
-    def gen_output(self):
-        models_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
-        hparams = model.default_hparams()
-        with open(os.path.join(models_dir, self.model_name, "hparams.json")) as f:
-            hparams.override_from_dict(json.load(f))
-        seed = np.random.randint(0, 100000)
-        self.output = sample.sample_sequence(
-            hparams=hparams,
-            length=self.generate_num,
-            context=self.context,
-            batch_size=self.batch_size,
-            temperature=self.temp,
-            #top_k=self.top_k,
-            top_p=self.top_p,
-        )
-
     def change_temp(self, t):
         changed = t != self.temp
         self.temp = t
@@ -0,0 +1,139 @@
+"""Keep one model loaded and sample for any number of play.py processes.
+
+Run from the repository root:
+    python -m generator.gpt2.inference_server model_v5
+and start the games with AIDUNGEON_SERVER=localhost:5005 so they use a RemoteGenerator.
+
+Clients send one JSON object per line:
+    {"context": [token ids], "length": 80, "temperature": 0.4, "top_p": 0.9,
+     "raw": false, "candidates": 1, "max_sentences": 0, "timeout": 120}
+and get back {"tokens": [new token ids of every candidate]} after every step, then
+{"done": true, "queue_wait": seconds, "latency": seconds}, or {"error": "..."}.
+
+Send {"stats": true} instead to get the queue wait and latency of recent requests.
+Closing the connection cancels the request it was waiting on.
+
+All requests are decoded in one batch that they join and leave between steps of
+step_tokens tokens, see scheduler.py.
+"""
+
+import argparse
+import json
+import socketserver
+import threading
+
+from generator.gpt2.gpt2_generator import BACKENDS, GPT2Generator
+from generator.gpt2.scheduler import Request, Scheduler
+
+DEFAULT_PORT = 5005
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = None
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                    if message.get("stats"):
+                        self.reply(self.server.scheduler.stats.summary())
+                        continue
+                    request = Request(message)
+                except (ValueError, KeyError, TypeError, AttributeError) as error:
+                    self.reply({"error": "bad request: " + str(error)})
+                    continue
+                self.server.scheduler.submit(request)
+                while True:
+                    reply = request.replies.get()
+                    self.reply(reply)
+                    if "tokens" not in reply:
+                        break
+        except OSError:
+            # The client went away, e.g. a RemoteGenerator past its deadline, so
+            # nobody wants the rest of its request
+            if request is not None:
+                request.cancelled = True
+
+    def reply(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class InferenceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, address, generator, max_batch=16, step_tokens=None, report_every=None
+    ):
+        super().__init__(address, RequestHandler)
+        self.scheduler = Scheduler(
+            generator, max_batch=max_batch, step_tokens=step_tokens
+        )
+        # The model is only ever run from this thread
+        threading.Thread(
+            target=self.scheduler.run_forever, args=(report_every,), daemon=True
+        ).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a model to several games at once.")
+    parser.add_argument("model_name", nargs="?", default="model_v5")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--backend", choices=BACKENDS, default="tensorflow")
+    parser.add_argument("--quantization", default=None)
+    parser.add_argument(
+        "--draft_model",
+        default=None,
+        help="smaller model that drafts tokens when one request is running (numpy backend)",
+    )
+    parser.add_argument(
+        "--prompt_lookup",
+        action="store_true",
+        help="draft tokens by copying from the prompt instead (numpy backend)",
+    )
+    parser.add_argument("--draft_tokens", type=int, default=4)
+    parser.add_argument("--max_batch", type=int, default=16)
+    parser.add_argument(
+        "--step_tokens",
+        type=int,
+        default=None,
+        help="tokens sampled between changes to the batch (default: stream_chunk)",
+    )
+    parser.add_argument(
+        "--cache_mb",
+        type=int,
+        default=2048,
+        help="memory for the keys/values of recent contexts, in MiB",
+    )
+    parser.add_argument(
+        "--report_every",
+        type=float,
+        default=60,
+        help="seconds between printing queue wait and latency stats",
+    )
+    args = parser.parse_args()
+
+    generator = GPT2Generator(
+        model_name=args.model_name,
+        quantization=args.quantization,
+        backend=args.backend,
+        draft_model=args.draft_model,
+        draft_tokens=args.draft_tokens,
+        prompt_lookup=args.prompt_lookup,
+        cache_mb=args.cache_mb,
+    )
+    server = InferenceServer(
+        (args.host, args.port),
+        generator,
+        max_batch=args.max_batch,
+        step_tokens=args.step_tokens,
+        report_every=args.report_every,
+    )
+    print("Serving {} on {}:{}".format(args.model_name, args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import os
+
+import numpy as np
+from generator.gpt2.prefix_cache import PrefixCache
+from generator.gpt2.src import np_model, np_sample, weights
+
+
+def load_weights(model_path, quantization=None):
+    weights_path = os.path.join(model_path, weights.weights_file(quantization))
+    if not weights.is_current(weights_path, weights.latest_checkpoint(model_path)):
+        # Exporting needs TensorFlow, which this backend is for doing without
+        model_name = os.path.basename(model_path)
+        command = "python -m generator.gpt2.export_weights " + model_name
+        if quantization is not None:
+            command += " and python -m generator.gpt2.quantize {} {}".format(
+                model_name, quantization
+            )
+        raise FileNotFoundError(
+            "The numpy backend needs weights exported from the latest checkpoint; "
+            "run " + command
+        )
+    return weights.load(weights_path)[0]
+
+
+class NumpyBackend:
+    """Runs np_sample.sample_sequence on memory-mapped weights, without TensorFlow.
+
+    With a draft_path, batches of one are sampled speculatively: the smaller model
+    there (e.g. 124M for model_v5) drafts draft_tokens tokens at a time, see
+    np_sample.speculative_sample_sequence. With prompt_lookup the drafts are instead
+    copied from earlier in the prompt, see np_sample.PromptLookup.
+    """
+
+    def __init__(
+        self,
+        hparams,
+        model_path,
+        quantization=None,
+        sentence_tokens=None,
+        end_token=None,
+        draft_path=None,
+        draft_tokens=4,
+        prompt_lookup=False,
+    ):
+        self.hparams = hparams
+        self.sentence_tokens = sentence_tokens
+        self.end_token = end_token
+        self.weights = load_weights(model_path, quantization)
+        self.rng = np.random.RandomState()
+
+        self.draft_hparams = None
+        self.draft_tokens = draft_tokens
+        self.prompt_lookup = prompt_lookup
+        if draft_path is not None:
+            self.draft_hparams = np_model.default_hparams()
+            with open(os.path.join(draft_path, "hparams.json")) as f:
+                self.draft_hparams.override_from_dict(json.load(f))
+            if self.draft_hparams.n_vocab != hparams.n_vocab:
+                raise ValueError("The draft model must have the same vocabulary")
+            self.draft_weights = load_weights(draft_path)
+            # The draft model's keys/values of recent contexts, like
+            # GPT2Generator.prefix_cache for the model's
+            self.draft_cache = PrefixCache(max_bytes=256 << 20)
+
+    def sample(
+        self,
+        context,
+        past,
+        past_tokens,
+        *,
+        length,
+        temperature,
+        top_p,
+        penalty,
+        penalty_window,
+        nucleus_candidates,
+        stop_tokens,
+        max_sentences,
+        padding=None,
+        deadline=None,
+        context_past=True,
+        keep_past=True,
+    ):
+        # The pasts are views of the sampling loop's cache, so there's nothing to skip
+        context = np.asarray(context, dtype=np.int32)
+        if (
+            (self.draft_hparams is not None or self.prompt_lookup)
+            and context.shape[0] == 1
+            and (padding is None or not np.any(padding))
+        ):
+            return self.sample_speculatively(
+                context,
+                past,
+                past_tokens,
+                length=length,
+                temperature=temperature,
+                top_p=top_p,
+                penalty=penalty,
+                penalty_window=penalty_window,
+                nucleus_candidates=nucleus_candidates,
+                stop_tokens=stop_tokens,
+                max_sentences=max_sentences,
+                deadline=deadline,
+            )
+        return np_sample.sample_sequence(
+            hparams=self.hparams,
+            weights=self.weights,
+            length=length,
+            context=context,
+            past=past,
+            past_tokens=past_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            penalty=penalty,
+            penalty_window=penalty_window,
+            nucleus_candidates=nucleus_candidates,
+            padding=padding,
+            stop_tokens=stop_tokens,
+            sentence_tokens=self.sentence_tokens,
+            max_sentences=max_sentences,
+            end_token=self.end_token,
+            rng=self.rng,
+            deadline=deadline,
+        )
+
+    def sample_speculatively(self, context, past, past_tokens, *, length, **settings):
+        if self.draft_hparams is None:
+            drafter = np_sample.PromptLookup(self.hparams.n_vocab)
+            return self.run_speculatively(
+                drafter, context, past, past_tokens, length=length, **settings
+            )
+
+        history = [int(token) for token in np.asarray(past_tokens).reshape(-1)]
+        history += [int(token) for token in context[0]]
+        reused, draft_past = self.draft_cache.lookup(history[:-1])
+        if reused == 0:
+            draft_past = np.zeros(
+                np_model.past_shape(hparams=self.draft_hparams, batch_size=1, sequence=0),
+                dtype=np.float32,
+            )
+        drafter = np_sample.DraftModel(
+            self.draft_hparams,
+            self.draft_weights,
+            draft_past,
+            history[:reused],
+            len(history) + length,
+        )
+        results = self.run_speculatively(
+            drafter, context, past, past_tokens, length=length, **settings
+        )
+        if drafter.tokens[: len(history)] == history:
+            self.draft_cache.insert(history, drafter.cache[..., : len(history), :])
+        return results
+
+    def run_speculatively(self, drafter, context, past, past_tokens, **settings):
+        return np_sample.speculative_sample_sequence(
+            hparams=self.hparams,
+            weights=self.weights,
+            drafter=drafter,
+            draft_tokens=self.draft_tokens,
+            context=context,
+            past=past,
+            past_tokens=past_tokens,
+            sentence_tokens=self.sentence_tokens,
+            end_token=self.end_token,
+            rng=self.rng,
+            **settings
+        )
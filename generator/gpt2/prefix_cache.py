@@ -0,0 +1,111 @@
+"""Keys/values of recently run prompts, found again by their longest shared prefix.
+
+Attention is causal, so the keys/values of a prompt's first n tokens are the first n
+columns of the prompt's own, whatever follows. One stored past therefore serves every
+prefix of its tokens: games started with the same character and name share their
+context, and /retry or the next turn share everything but the end of the prompt.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Node:
+    __slots__ = ("children", "entry", "stored")
+
+    def __init__(self):
+        self.children = {}
+        # Some entry whose tokens pass through this node, to look prefixes up in
+        self.entry = None
+        # The entry whose tokens end at this node, if any
+        self.stored = None
+
+
+class Entry:
+    __slots__ = ("tokens", "past")
+
+    def __init__(self, tokens, past):
+        self.tokens = tokens
+        self.past = past
+
+
+class PrefixCache:
+    """Trie of token sequences and their keys/values for a batch of one.
+
+    Least recently used entries are evicted once they take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=2 << 30):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self.root = Node()
+        # Entries by tokens, least recently used first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def lookup(self, tokens):
+        """Length of the longest cached prefix of tokens and that prefix's past."""
+        node = self.root
+        depth = 0
+        for token in tokens:
+            node = node.children.get(token)
+            if node is None:
+                break
+            depth += 1
+            entry = node.entry
+        if depth == 0:
+            return 0, None
+        self.entries.move_to_end(entry.tokens)
+        return depth, entry.past[..., :depth, :]
+
+    def insert(self, tokens, past):
+        """Store past, which covers at least tokens, unless a longer entry has it."""
+        tokens = tuple(int(token) for token in tokens)
+        if len(tokens) == 0:
+            return
+        node = self.root
+        prefixes = []
+        for token in tokens:
+            node = node.children.get(token)
+            if node is None:
+                break
+            if node.stored is not None:
+                prefixes.append(node.stored)
+        else:
+            # Already covered by this entry or a longer one
+            self.entries.move_to_end(node.entry.tokens)
+            return
+        # Shorter prompts this one extends aren't needed anymore
+        for stored in prefixes:
+            self.remove(stored)
+
+        # Copy, so a view doesn't keep the backend's whole buffer alive
+        entry = Entry(tokens, np.array(past[..., : len(tokens), :]))
+        if entry.past.nbytes > self.max_bytes:
+            return
+        node = self.root
+        for token in tokens:
+            node = node.children.setdefault(token, Node())
+            node.entry = entry
+        node.stored = entry
+        self.entries[tokens] = entry
+        self.nbytes += entry.past.nbytes
+        while self.nbytes > self.max_bytes:
+            self.remove(next(iter(self.entries.values())))
+
+    def remove(self, entry):
+        del self.entries[entry.tokens]
+        self.nbytes -= entry.past.nbytes
+        path = [self.root]
+        for token in entry.tokens:
+            path.append(path[-1].children[token])
+        path[-1].stored = None
+        for i in range(len(entry.tokens), 0, -1):
+            node = path[i]
+            if node.stored is None and len(node.children) == 0:
+                del path[i - 1].children[entry.tokens[i - 1]]
+            elif node.entry is entry:
+                node.entry = node.stored or next(iter(node.children.values())).entry
@@ -0,0 +1,130 @@
+"""Quantize a model's weights for CPU inference and compare it with float32.
+
+Run from the repository root, after exporting the weights with export_weights:
+    python -m generator.gpt2.quantize model_v5 int8
+    python -m generator.gpt2.quantize model_v5 int8 --compare
+
+Then start the generator with GPT2Generator(quantization="int8").
+
+This trades speed for memory. int8 weights take a quarter of the memory of float32
+ones and float16 weights half, but both backends convert them to float32 for every
+matmul, so decoding is slower than with float32 weights (--compare shows how much).
+Use them when the model doesn't fit in RAM otherwise.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import yaml
+from generator.gpt2.gpt2_generator import GPT2Generator
+from generator.gpt2.src import weights
+
+models_dir = "generator/gpt2/models"
+
+
+def quantize(model_name, quantization):
+    path = os.path.join(models_dir, model_name, weights.WEIGHTS_FILE)
+    arrays, metadata = weights.load(path)
+    out_path = os.path.join(models_dir, model_name, weights.weights_file(quantization))
+    weights.save(
+        out_path,
+        weights.quantize(arrays, quantization),
+        dict(metadata, quantization=quantization),
+    )
+    return out_path
+
+
+def log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+
+def measure(model_name, quantization, prompts, length):
+    """Log probabilities for every prompt position, and prefill/decode timings.
+
+    Decoding is timed as the difference between sampling length tokens and sampling
+    one, so the prefill both start with cancels out.
+    """
+    # Converting doesn't need TensorFlow, only comparing does
+    import tensorflow as tf
+    from generator.gpt2.src import model
+
+    with tf.Graph().as_default():
+        generator = GPT2Generator(
+            model_name=model_name, quantization=quantization, generate_num=length
+        )
+        # Always sample the full length so the timings compare like with like
+        generator.stop_tokens[:] = False
+        generator.raw_stop_tokens[:] = False
+        tokens = tf.placeholder(tf.int32, [1, None])
+        with tf.variable_scope(
+            tf.get_variable_scope(), custom_getter=generator.backend.weight_getter
+        ):
+            logits = model.model(generator.hparams, tokens, reuse=tf.AUTO_REUSE)["logits"]
+
+        log_probs = []
+        prefill = 0
+        decode = 0
+        for prompt in prompts:
+            context = generator.enc.encode(prompt)
+            start = time.time()
+            out = generator.backend.sess.run(
+                logits, feed_dict={tokens: [context], **generator.backend.weight_feeds}
+            )
+            prefill += time.time() - start
+            log_probs.append(log_softmax(out[0]))
+
+            for generate_num, sign in ((length, 1), (1, -1)):
+                generator.generate_num = generate_num
+                generator.clear_cache()
+                start = time.time()
+                generator.generate_raw(prompt)
+                decode += sign * (time.time() - start)
+        generator.backend.sess.close()
+    return log_probs, prefill / len(prompts), decode / (len(prompts) * (length - 1))
+
+
+def compare(model_name, quantization, length=40):
+    with open("story/story_data.yaml", "r") as stream:
+        data = yaml.safe_load(stream)
+    prompts = [
+        character["prompts"][0]
+        for setting in data["settings"].values()
+        for character in setting["characters"].values()
+    ]
+
+    reference, ref_prefill, ref_decode = measure(model_name, None, prompts, length)
+    quantized, q_prefill, q_decode = measure(model_name, quantization, prompts, length)
+
+    kl = []
+    agree = []
+    for p, q in zip(reference, quantized):
+        kl.append((np.exp(p) * (p - q)).sum(axis=-1))
+        agree.append(p.argmax(axis=-1) == q.argmax(axis=-1))
+    kl = np.concatenate(kl)
+    agree = np.concatenate(agree)
+
+    print("Compared on {} prompts ({} positions)".format(len(prompts), len(kl)))
+    print("                      float32   {}".format(quantization))
+    print("prefill s/prompt:     {:7.3f}   {:7.3f}".format(ref_prefill, q_prefill))
+    print("decode s/token:       {:7.3f}   {:7.3f}".format(ref_decode, q_decode))
+    print("mean KL(fp32 || {}): {:.5f} (max {:.5f})".format(quantization, kl.mean(), kl.max()))
+    print("top-1 agreement:      {:.2%}".format(agree.mean()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize exported model weights.")
+    parser.add_argument("model_name")
+    parser.add_argument("quantization", choices=weights.QUANTIZATIONS)
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare quality and latency with float32 instead of converting",
+    )
+    args = parser.parse_args()
+    if args.compare:
+        compare(args.model_name, args.quantization)
+    else:
+        print("Wrote " + quantize(args.model_name, args.quantization))
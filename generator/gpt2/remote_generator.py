@@ -0,0 +1,86 @@
+import json
+import socket
+import time
+
+from generator.gpt2.gpt2_generator import GPT2Generator
+from generator.gpt2.inference_server import DEFAULT_PORT
+
+
+class RemoteGenerator(GPT2Generator):
+    """GPT2Generator that samples on an inference_server instead of loading the model.
+
+    Prompts are still built, encoded and cleaned up here; only token ids are sent to
+    the server, so this needs the model's encoder and hparams.json but not its weights.
+    """
+
+    def __init__(self, address="localhost", **kwargs):
+        host, _, port = address.partition(":")
+        self.address = (host, int(port) if port else DEFAULT_PORT)
+        super().__init__(**kwargs)
+
+    def load_backend(self, backend, quantization):
+        return None
+
+    def request(self, prompt, candidates, length=None):
+        """Yield the new tokens of every candidate as the server samples them."""
+        message = {
+            "context": self.fit_context(prompt),
+            "length": self.generate_num if length is None else length,
+            "temperature": self.temp,
+            "top_p": self.top_p,
+            "raw": self.raw,
+            "candidates": candidates,
+            "max_sentences": self.max_sentences,
+        }
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                raise TimeoutError("Generation deadline passed")
+            message["timeout"] = timeout
+        with socket.create_connection(self.address) as connection:
+            if timeout is not None:
+                # Leave the server time to report the timeout itself
+                connection.settimeout(timeout + 10)
+            connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+            try:
+                for line in connection.makefile("r", encoding="utf-8"):
+                    reply = json.loads(line)
+                    if reply.get("error") == "timeout":
+                        raise TimeoutError("Generation deadline passed")
+                    if "error" in reply:
+                        raise RuntimeError("Inference server: " + reply["error"])
+                    if reply.get("done"):
+                        return
+                    # The deadline can be brought forward while waiting, see
+                    # IdleWorker.pause
+                    if self.deadline is not None and time.time() > self.deadline:
+                        raise TimeoutError("Generation deadline passed")
+                    yield reply["tokens"]
+            except socket.timeout:
+                raise TimeoutError("Inference server did not answer in time")
+        raise ConnectionError("Inference server closed the connection")
+
+    def generate_raw_batch(self, prompt, batch_size):
+        generated = [[] for _ in range(batch_size)]
+        for tokens in self.request(prompt, batch_size):
+            for i in range(batch_size):
+                generated[i].extend(tokens[i])
+        return [self.enc.decode(tokens) for tokens in generated]
+
+    def prefill(self, prompt):
+        # The server caches the keys/values of every context it runs
+        for _ in self.request(self.prompt_replace(prompt), 1, length=1):
+            pass
+
+    def stream_raw(self, prompt):
+        decoder = self.enc.incremental_decoder()
+        for tokens in self.request(prompt, 1):
+            yield decoder.decode(tokens[0])
+        yield decoder.flush()
+
+    def stream_raw_batch(self, prompt, batch_size):
+        decoders = [self.enc.incremental_decoder() for _ in range(batch_size)]
+        for tokens in self.request(prompt, batch_size):
+            yield [decoder.decode(row) for decoder, row in zip(decoders, tokens)]
+        yield [decoder.flush() for decoder in decoders]
@@ -0,0 +1,400 @@
+"""Continuous batching for the inference server.
+
+Every candidate of every request is a row of one running batch. Between decoding steps
+finished rows leave and waiting requests join, so short requests don't wait for long
+ones and new ones don't wait for the batch to drain. Rows have different lengths; they
+are kept left-padded (see model.model) and each keeps its own settings, length limit
+and stop condition.
+
+Contexts are looked up in the generator's prefix_cache, so a request only has to run
+the model over what follows the longest prefix an earlier one already computed.
+"""
+
+import queue
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+from generator.gpt2.src import np_model
+
+
+class Request:
+    def __init__(self, message):
+        self.context = [int(token) for token in message["context"]]
+        self.length = int(message.get("length", 80))
+        self.temperature = float(message.get("temperature", 0.4))
+        self.top_p = float(message.get("top_p", 0.9))
+        self.raw = bool(message.get("raw", False))
+        self.candidates = int(message.get("candidates", 1))
+        self.max_sentences = int(message.get("max_sentences", 0))
+        self.deadline = None
+        if message.get("timeout") is not None:
+            self.deadline = time.time() + float(message["timeout"])
+        if len(self.context) == 0 or self.length <= 0 or self.candidates <= 0:
+            raise ValueError("context, length and candidates must not be empty")
+        self.timed_out = False
+        # Set when the client goes away; its rows leave the batch on the next step
+        self.cancelled = False
+        # One Row per candidate while the request is decoded
+        self.rows = []
+        # Messages for the connection that sent the request
+        self.replies = queue.Queue()
+        # time.time() of every stage, for LatencyStats
+        self.queued = self.admitted = self.first_token = None
+
+
+class Row:
+    """One candidate of a request while it is decoded."""
+
+    def __init__(self, request):
+        self.request = request
+        self.generated = []
+        # Tokens added by the last decoding step
+        self.new = []
+        self.finished = False
+
+    def remaining(self):
+        return self.request.length - len(self.generated)
+
+    def add(self, tokens, stop_tokens, sentence_tokens):
+        """Append the sampled tokens up to where decoding should have stopped."""
+        request = self.request
+        self.new = new = []
+        for token in tokens[: self.remaining()]:
+            new.append(int(token))
+            if stop_tokens[token]:
+                self.finished = True
+                break
+            if request.max_sentences > 0:
+                sentences = int(sentence_tokens[self.generated + new].sum())
+                if sentences >= request.max_sentences:
+                    self.finished = True
+                    break
+        self.generated.extend(new)
+        if self.remaining() <= 0:
+            self.finished = True
+
+
+class LatencyStats:
+    """Timings of the most recent requests and batch sizes of the most recent steps."""
+
+    def __init__(self, size=1000):
+        self.requests = deque(maxlen=size)
+        self.batch_sizes = deque(maxlen=size)
+
+    def record(self, request, finished):
+        tokens = sum(len(row.generated) for row in request.rows)
+        self.requests.append(
+            (
+                request.admitted - request.queued,
+                request.first_token - request.queued,
+                finished - request.queued,
+                tokens,
+            )
+        )
+
+    def summary(self):
+        if len(self.requests) == 0:
+            return {"requests": 0}
+        queue_wait, first_token, latency, tokens = np.array(self.requests).T
+        summary = {"requests": len(self.requests)}
+        for name, values in (
+            ("queue_wait", queue_wait),
+            ("first_token", first_token),
+            ("latency", latency),
+        ):
+            summary[name] = {
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+            }
+        summary["tokens_per_request"] = float(tokens.mean())
+        summary["mean_batch_size"] = float(np.mean(self.batch_sizes))
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if summary["requests"] == 0:
+            return "no requests yet"
+        return (
+            "{requests} requests, queue wait {queue_wait[mean]:.2f}s "
+            "(p95 {queue_wait[p95]:.2f}s), first token {first_token[mean]:.2f}s, "
+            "latency {latency[mean]:.2f}s (p95 {latency[p95]:.2f}s), "
+            "{tokens_per_request:.0f} tokens/request, "
+            "batch size {mean_batch_size:.1f}".format(**summary)
+        )
+
+
+class Scheduler:
+    def __init__(self, generator, max_batch=16, step_tokens=None):
+        self.generator = generator
+        self.max_batch = max_batch
+        # Tokens sampled per backend call; rows can only join or leave in between
+        self.step_tokens = step_tokens or generator.stream_chunk
+        self.pending = queue.Queue()
+        self.waiting = deque()
+        self.stats = LatencyStats()
+        self.prefix_cache = generator.prefix_cache
+
+        # The running batch: keys/values of everything but the last sampled token of
+        # every row, those tokens, the last tokens, and each row's left padding
+        self.rows = []
+        self.past = self.empty_past(0)
+        self.past_tokens = np.zeros([0, 0], dtype=np.int32)
+        self.feed = np.zeros([0, 1], dtype=np.int32)
+        self.padding = np.zeros([0], dtype=np.int32)
+
+    def submit(self, request):
+        request.queued = time.time()
+        self.pending.put(request)
+
+    def empty_past(self, batch_size):
+        shape = np_model.past_shape(
+            hparams=self.generator.hparams, batch_size=batch_size, sequence=0
+        )
+        return np.zeros(shape, dtype=np.float32)
+
+    def check(self, request):
+        """Why the model can't run request, or None if it can."""
+        hparams = self.generator.hparams
+        if len(request.context) + request.length > hparams.n_ctx:
+            return "bad request: context and length must fit in {} tokens".format(
+                hparams.n_ctx
+            )
+        if min(request.context) < 0 or max(request.context) >= hparams.n_vocab:
+            return "bad request: token ids must be below {}".format(hparams.n_vocab)
+        return None
+
+    def admit(self, timeout=None):
+        """Take waiting requests in order while their candidates fit in the batch.
+
+        Blocks for up to timeout seconds when nothing is running. Requests the model
+        can't run get an error here, so they never fail the rest of the batch.
+        """
+        if len(self.rows) == 0 and len(self.waiting) == 0:
+            try:
+                self.waiting.append(self.pending.get(timeout=timeout))
+            except queue.Empty:
+                return []
+        while True:
+            try:
+                self.waiting.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        admitted = []
+        room = self.max_batch - len(self.rows)
+        while len(self.waiting) > 0:
+            if self.waiting[0].cancelled:
+                self.waiting.popleft()
+                continue
+            error = self.check(self.waiting[0])
+            if error is not None:
+                self.waiting.popleft().replies.put({"error": error})
+                continue
+            candidates = self.waiting[0].candidates
+            # A request bigger than max_batch still runs, on its own
+            if candidates > room and (len(self.rows) > 0 or len(admitted) > 0):
+                break
+            room -= candidates
+            admitted.append(self.waiting.popleft())
+        return admitted
+
+    def step(self):
+        """Admit waiting requests and decode the running batch by step_tokens."""
+        admitted = self.admit(timeout=1)
+        if len(admitted) > 0:
+            self.prefill(admitted)
+        if len(self.rows) > 0:
+            self.stats.batch_sizes.append(len(self.rows))
+            rows = self.rows
+            results, sequence = self.run(
+                rows, self.feed, self.past, self.past_tokens, self.padding
+            )
+            past = results["past"]
+            self.set_batch(*self.finish(rows, past, sequence, self.padding))
+
+    def prefill(self, requests):
+        """Run the contexts of requests and add them to the batch.
+
+        Requests with a cached prefix each start from their own past; the rest are run
+        together, left-padded.
+        """
+        now = time.time()
+        uncached = []
+        for request in requests:
+            request.admitted = now
+            request.rows = [Row(request) for _ in range(request.candidates)]
+            reused, past = self.prefix_cache.lookup(request.context[:-1])
+            if reused > 0:
+                self.prefill_group([request], reused, past)
+            else:
+                uncached.append(request)
+        if len(uncached) > 0:
+            self.prefill_group(uncached, 0, self.empty_past(1))
+
+    def prefill_group(self, requests, reused, past):
+        """Run what follows the first reused tokens of the contexts of requests."""
+        rows = [row for request in requests for row in request.rows]
+        width = max(len(request.context) for request in requests) - reused
+        padding = np.array(
+            [width + reused - len(row.request.context) for row in rows], dtype=np.int32
+        )
+        pad_token = self.generator.end_token
+        feed = np.array(
+            [
+                [pad_token] * int(padding[i]) + row.request.context[reused:]
+                for i, row in enumerate(rows)
+            ],
+            dtype=np.int32,
+        )
+        past_tokens = np.array(
+            [row.request.context[:reused] for row in rows], dtype=np.int32
+        ).reshape([len(rows), reused])
+        try:
+            results, sequence = self.run(
+                rows,
+                feed,
+                np.repeat(past, len(rows), axis=0),
+                past_tokens,
+                padding,
+                context_past=True,
+            )
+        except Exception as error:
+            for request in requests:
+                request.replies.put({"error": str(error)})
+            return
+        past = results["past"]
+        first = 0
+        for request in requests:
+            # Padded keys/values are left of the context's
+            self.prefix_cache.insert(
+                request.context,
+                results["context_past"][first : first + 1, ..., padding[first] :, :],
+            )
+            first += request.candidates
+        running = np.concatenate([self.past_tokens, self.feed], axis=1)
+        self.set_batch(
+            *merge(
+                (self.rows, self.past, running, self.padding),
+                self.finish(rows, past, sequence, padding),
+                self.generator.end_token,
+            )
+        )
+
+    def run(self, rows, feed, past, past_tokens, padding, context_past=False):
+        """Sample up to step_tokens for rows; returns the results and all tokens."""
+        generator = self.generator
+        results = generator.backend.sample(
+            feed,
+            past,
+            past_tokens,
+            length=min([self.step_tokens] + [row.remaining() for row in rows]),
+            temperature=np.array([row.request.temperature for row in rows], np.float32),
+            top_p=np.array([row.request.top_p for row in rows], np.float32),
+            penalty=generator.penalty,
+            penalty_window=generator.penalty_window,
+            nucleus_candidates=generator.nucleus_candidates,
+            # Every row stops on these; Row.add also cuts rows that aren't raw at ">"
+            stop_tokens=generator.raw_stop_tokens,
+            max_sentences=0,
+            padding=padding,
+            context_past=context_past,
+        )
+        sampled = results["tokens"][:, feed.shape[1] :]
+        for row, tokens in zip(rows, sampled):
+            if row.request.raw:
+                row.add(tokens, generator.raw_stop_tokens, generator.sentence_tokens)
+            else:
+                row.add(tokens, generator.stop_tokens, generator.sentence_tokens)
+        return results, np.concatenate([past_tokens, feed, sampled], axis=1)
+
+    def finish(self, rows, past, sequence, padding):
+        """Send the tokens of the last step and drop rows that are done."""
+        now = time.time()
+        for request in unique(row.request for row in rows):
+            if request.first_token is None:
+                request.first_token = now
+            if request.cancelled:
+                continue
+            if request.deadline is not None and now > request.deadline:
+                request.replies.put({"error": "timeout"})
+                request.timed_out = True
+                continue
+            request.replies.put({"tokens": [row.new for row in request.rows]})
+            for row in request.rows:
+                row.new = []
+            if all(row.finished for row in request.rows):
+                self.stats.record(request, now)
+                request.replies.put(
+                    {
+                        "done": True,
+                        "queue_wait": request.admitted - request.queued,
+                        "latency": now - request.queued,
+                    }
+                )
+        keep = [
+            i
+            for i, row in enumerate(rows)
+            if not (row.finished or row.request.timed_out or row.request.cancelled)
+        ]
+        return [rows[i] for i in keep], past[keep], sequence[keep], padding[keep]
+
+    def set_batch(self, rows, past, sequence, padding):
+        # Padding every remaining row has in common is dropped
+        trim = int(padding.min()) if len(rows) > 0 else sequence.shape[1] - 1
+        self.rows = rows
+        self.past = past[..., trim:, :]
+        self.past_tokens = sequence[:, trim:-1]
+        self.feed = sequence[:, -1:]
+        self.padding = padding - trim
+
+    def fail(self, error):
+        """Report error to every running request and empty the batch."""
+        for request in unique(row.request for row in self.rows):
+            request.replies.put({"error": str(error)})
+        self.set_batch(
+            [],
+            self.empty_past(0),
+            np.zeros([0, 1], dtype=np.int32),
+            np.zeros([0], dtype=np.int32),
+        )
+
+    def run_forever(self, report_every=None):
+        """Keep decoding, printing the stats every report_every seconds."""
+        last_report = time.time()
+        while True:
+            try:
+                self.step()
+            except Exception as error:
+                self.fail(error)
+            if report_every is not None and time.time() - last_report > report_every:
+                print(self.stats.report())
+                last_report = time.time()
+
+
+def unique(items):
+    return list(OrderedDict((id(item), item) for item in items).values())
+
+
+def merge(first, second, pad_token):
+    """Stack two batches of (rows, past, tokens, padding), left-padding the shorter one.
+
+    Padded keys/values are zeros and masked out like padded tokens, so the rows of
+    both decode exactly as before.
+    """
+    length = max(first[2].shape[1], second[2].shape[1])
+    parts = []
+    for rows, past, tokens, padding in (first, second):
+        extra = length - tokens.shape[1]
+        past = np.pad(past, [(0, 0)] * 4 + [(extra, 0), (0, 0)], mode="constant")
+        tokens = np.pad(
+            tokens, [(0, 0), (extra, 0)], mode="constant", constant_values=pad_token
+        )
+        parts.append((rows, past, tokens, padding + extra))
+    (rows_a, past_a, tokens_a, padding_a), (rows_b, past_b, tokens_b, padding_b) = parts
+    return (
+        rows_a + rows_b,
+        np.concatenate([past_a, past_b]),
+        np.concatenate([tokens_a, tokens_b]),
+        np.concatenate([padding_a, padding_b]),
+    )
@@ -1,7 +1,16 @@
 """Byte pair encoding utilities"""
 
+import array
+import codecs
+import heapq
 import json
+import mmap
 import os
+import struct
+import sys
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from functools import lru_cache
 
 import regex as re
@@ -48,14 +57,39 @@ def get_pairs(word):
 
 
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(
+        self,
+        encoder,
+        bpe_merges,
+        errors="replace",
+        cache_size=2 ** 16,
+        decoder=None,
+        token_bytes=None,
+        bpe_ranks=None,
+    ):
         self.encoder = encoder
-        self.decoder = {v: k for k, v in self.encoder.items()}
+        if decoder is None:
+            decoder = {v: k for k, v in self.encoder.items()}
+        self.decoder = decoder
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # The UTF-8 bytes every token stands for
+        if token_bytes is None:
+            token_bytes = {
+                token: bytes(self.byte_decoder[c] for c in text)
+                for token, text in self.decoder.items()
+            }
+        self.token_bytes = token_bytes
+        if bpe_ranks is None:
+            bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.bpe_ranks = bpe_ranks
+        # Least recently used words are dropped once the cache holds cache_size of them
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # (text, piece end offsets, token counts up to each piece, tokens) of the last
+        # encode, so text that only had something appended isn't tokenized again
+        self.last_encoding = ("", [], [], [])
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(
@@ -64,71 +98,382 @@ class Encoder:
 
     def bpe(self, token):
         if token in self.cache:
+            self.cache.move_to_end(token)
             return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+        word = self.merge(token)
+        self.cache[token] = word
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return word
+
+    def merge(self, token):
+        """Apply the BPE merges to token.
 
-        if not pairs:
+        Symbols are kept in a linked list and candidate pairs in a heap keyed by merge
+        rank and position. All pairs of the lowest rank are merged left to right before
+        moving on, which gives the same result as rescanning the word for the best pair
+        after every merge.
+        """
+        symbols = list(token)
+        if len(symbols) < 2:
             return token
+        ranks = self.bpe_ranks
+        nxt = list(range(1, len(symbols))) + [-1]
+        prev = list(range(-1, len(symbols) - 1))
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
-        return word
+        while heap:
+            rank = heap[0][0]
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+            for i in positions:
+                j = nxt[i]
+                # Skip pairs that an earlier merge has changed
+                if symbols[i] is None or j == -1 or ranks.get((symbols[i], symbols[j])) != rank:
+                    continue
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                nxt[i] = nxt[j]
+                if nxt[i] != -1:
+                    prev[nxt[i]] = i
+                    new_rank = ranks.get((symbols[i], symbols[nxt[i]]))
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, i))
+                if prev[i] != -1:
+                    new_rank = ranks.get((symbols[prev[i]], symbols[i]))
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, prev[i]))
+
+        return " ".join(symbol for symbol in symbols if symbol is not None)
+
+    def encode(self, text, incremental=True):
+        """Encode text, reusing the tokens of the previous call for a shared prefix.
+
+        A pretokenized piece only depends on its own characters and the two after it
+        (whitespace runs look one character past the run), so every piece that ends at
+        least two characters before the first change is kept. Pass incremental=False
+        for one-off text that shouldn't replace the remembered encoding.
+        """
+        last_text, last_ends, last_counts, last_tokens = (
+            self.last_encoding if incremental else ("", [], [], [])
+        )
+        shared = len(os.path.commonprefix([last_text, text]))
+        kept = bisect_left(last_ends, shared - 1)
+        ends = last_ends[:kept]
+        counts = last_counts[:kept]
+        bpe_tokens = last_tokens[: counts[-1]] if kept > 0 else []
+        start = ends[-1] if kept > 0 else 0
 
-    def encode(self, text):
-        bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+        for match in self.pat.finditer(text, start):
+            token = "".join(self.byte_encoder[b] for b in match.group().encode("utf-8"))
             bpe_tokens.extend(
                 self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
             )
-        return bpe_tokens
+            ends.append(match.end())
+            counts.append(len(bpe_tokens))
+
+        if incremental:
+            self.last_encoding = (text, ends, counts, bpe_tokens)
+        return list(bpe_tokens)
 
     def decode(self, tokens):
-        text = "".join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode(
+        return b"".join([self.token_bytes[token] for token in tokens]).decode(
             "utf-8", errors=self.errors
         )
-        return text
+
+    def incremental_decoder(self):
+        return IncrementalDecoder(self)
+
+    def tokens_containing(self, chars):
+        """Ids of the tokens with any of chars in their text."""
+        if isinstance(self.encoder, StringTable):
+            return self.encoder.containing(chars)
+        return [
+            token for text, token in self.encoder.items() if any(c in text for c in chars)
+        ]
+
+
+class IncrementalDecoder:
+    """Decodes tokens as they are generated, only looking at the new ones.
+
+    A character can be split over several tokens; its first bytes are held back until
+    the rest arrives, so the pieces returned join up to Encoder.decode of all tokens.
+    """
+
+    def __init__(self, encoder):
+        self.token_bytes = encoder.token_bytes
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors=encoder.errors)
+
+    def decode(self, tokens):
+        """The text completed by tokens."""
+        return self.decoder.decode(b"".join([self.token_bytes[token] for token in tokens]))
+
+    def flush(self):
+        """Whatever is still held back, once no more tokens will come."""
+        return self.decoder.decode(b"", final=True)
+
+
+COMPILED_FILE = "encoder.bin"
+# Bumped whenever the layout of COMPILED_FILE changes
+COMPILED_VERSION = 2
+SOURCE_FILES = ("encoder.json", "vocab.bpe")
+
+
+class Slices:
+    """Sequence of the bytes between consecutive offsets in data, decoded if encoding."""
+
+    def __init__(self, data, offsets, encoding=None):
+        self.data = data
+        self.offsets = offsets
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        data = self.data[self.offsets[index] : self.offsets[index + 1]]
+        return data if self.encoding is None else data.decode(self.encoding)
+
+
+class StringTable:
+    """Read-only str -> index lookups of strings stored back to back in a buffer.
+
+    slots is an open addressing hash table of index + 1 (0 for an empty slot) keyed
+    on the CRC-32 of a string's UTF-8, so a lookup hashes the key and compares it with
+    one or two stored strings instead of needing a dict of all of them.
+    """
+
+    def __init__(self, data, offsets, slots):
+        self.data = data
+        self.offsets = offsets
+        self.slots = slots
+        self.mask = len(slots) - 1
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def find(self, key):
+        """Index of key, or -1."""
+        key = key.encode("utf-8")
+        offsets = self.offsets
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            index = self.slots[slot] - 1
+            if index < 0 or self.data[offsets[index] : offsets[index + 1]] == key:
+                return index
+            slot = (slot + 1) & self.mask
+
+    def get(self, key, default=None):
+        index = self.find(key)
+        return default if index < 0 else index
+
+    def __getitem__(self, key):
+        index = self.find(key)
+        if index < 0:
+            raise KeyError(key)
+        return index
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def items(self):
+        strings = Slices(self.data, self.offsets, "utf-8")
+        for index in range(len(self)):
+            yield strings[index], index
+
+    def containing(self, chars):
+        """Indices of the strings with any of chars in them, in order."""
+        found = set()
+        for char in chars:
+            char = char.encode("utf-8")
+            position = self.data.find(char)
+            while position >= 0:
+                index = bisect_right(self.offsets, position) - 1
+                if position + len(char) <= self.offsets[index + 1]:
+                    found.add(index)
+                position = self.data.find(char, position + 1)
+        return sorted(found)
+
+
+class MergeRanks:
+    """bpe_ranks over a StringTable of "first second" merges."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, pair, default=None):
+        return self.table.get(pair[0] + " " + pair[1], default)
+
+
+def build_table(strings):
+    """The data, offsets and slots of a StringTable of strings."""
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = array.array("I", [0])
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    size = 1
+    while size < 2 * len(encoded):
+        size *= 2
+    slots = array.array("I", [0]) * size
+    for index, string in enumerate(encoded):
+        slot = zlib.crc32(string) & (size - 1)
+        # A repeated string keeps its last index, as in a dict
+        while slots[slot] != 0 and encoded[slots[slot] - 1] != string:
+            slot = (slot + 1) & (size - 1)
+        slots[slot] = index + 1
+    return b"".join(encoded), offsets, slots
+
+
+def source_stamps(model_dir):
+    """Size and modification time of the files an encoder is built from."""
+    stamps = {}
+    for name in SOURCE_FILES:
+        stat = os.stat(os.path.join(model_dir, name))
+        stamps[name] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
 
 
 def get_encoder(model_name, models_dir):
+    """Load the encoder of a model, from its compiled form if that is up to date.
+
+    Parsing encoder.json and vocab.bpe is most of the startup time of an Encoder, so
+    the first time they are compiled to COMPILED_FILE: hash tables the Encoder looks
+    tokens and merges up in where they lie, which loads in milliseconds. It is rebuilt
+    when the size or modification time of either file changes.
+    """
+    model_dir = os.path.join(models_dir, model_name)
+    try:
+        stamps = source_stamps(model_dir)
+    except OSError:
+        return None
+    compiled_path = os.path.join(model_dir, COMPILED_FILE)
+    try:
+        return load_compiled(compiled_path, stamps)
+    except (OSError, ValueError, KeyError, struct.error):
+        pass
+
     try:
-        with open(os.path.join(models_dir, model_name, "encoder.json"), "r") as f:
+        with open(os.path.join(model_dir, "encoder.json"), "r") as f:
             encoder = json.load(f)
-        with open(
-            os.path.join(models_dir, model_name, "vocab.bpe"), "r", encoding="utf-8"
-        ) as f:
+        with open(os.path.join(model_dir, "vocab.bpe"), "r", encoding="utf-8") as f:
             bpe_data = f.read()
-        bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
-        return Encoder(encoder=encoder, bpe_merges=bpe_merges,)
     except OSError:
         return None
+    bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
+    try:
+        data = compile_encoder(encoder, bpe_merges, stamps)
+    except ValueError:
+        return Encoder(encoder=encoder, bpe_merges=bpe_merges,)
+    try:
+        tmp_path = compiled_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, compiled_path)
+    except OSError:
+        # Read-only model directories just don't get the faster startup
+        pass
+    return from_compiled(data)
+
+
+def compile_encoder(encoder, bpe_merges, stamps):
+    """The contents of COMPILED_FILE for a vocabulary and merges.
+
+    Like a weights file, this is an 8 byte little-endian header length, a JSON header
+    and the data: a StringTable of the tokens by id, the bytes of every token with
+    their offsets, and a StringTable of the merges by rank.
+    """
+    n_tokens = len(encoder)
+    tokens = sorted(encoder, key=encoder.get)
+    if [encoder[token] for token in tokens] != list(range(n_tokens)):
+        raise ValueError("Token ids must be 0 to n_vocab - 1")
+    if array.array("I").itemsize != 4:
+        raise ValueError("Offsets are stored as 4 byte integers")
+    byte_decoder = {v: k for k, v in bytes_to_unicode().items()}
+    token_bytes = [bytes(byte_decoder[c] for c in token) for token in tokens]
+    byte_offsets = array.array("I", [0])
+    for data in token_bytes:
+        byte_offsets.append(byte_offsets[-1] + len(data))
+    token_data, token_offsets, token_slots = build_table(tokens)
+    merge_data, merge_offsets, merge_slots = build_table(
+        first + " " + second for first, second in bpe_merges
+    )
+
+    sections = [
+        ("token_data", token_data),
+        ("token_offsets", token_offsets),
+        ("token_slots", token_slots),
+        ("byte_data", b"".join(token_bytes)),
+        ("byte_offsets", byte_offsets),
+        ("merge_data", merge_data),
+        ("merge_offsets", merge_offsets),
+        ("merge_slots", merge_slots),
+    ]
+    header = {"version": COMPILED_VERSION, "sources": stamps}
+    parts = []
+    offset = 0
+    for name, data in sections:
+        if isinstance(data, array.array):
+            if sys.byteorder == "big":
+                data = array.array(data.typecode, data)
+                data.byteswap()
+            data = data.tobytes()
+        header[name] = [offset, len(data)]
+        offset += len(data)
+        parts.append(data)
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([struct.pack("<Q", len(header_bytes)), header_bytes] + parts)
+
+
+def load_compiled(path, stamps):
+    """Map COMPILED_FILE at path; ValueError if it wasn't built from stamps."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return from_compiled(data, stamps)
+
+
+def from_compiled(data, stamps=None):
+    """An Encoder that looks everything up in data, the output of compile_encoder."""
+    (length,) = struct.unpack("<Q", data[:8])
+    header = json.loads(data[8 : 8 + length].decode("utf-8"))
+    if header["version"] != COMPILED_VERSION:
+        raise ValueError("Compiled encoder has another format")
+    if stamps is not None and header["sources"] != stamps:
+        raise ValueError("Compiled encoder is out of date")
+    start = 8 + length
+
+    def section(name):
+        offset, size = header[name]
+        return data[start + offset : start + offset + size]
+
+    def integers(name):
+        values = array.array("I")
+        values.frombytes(section(name))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    tokens = StringTable(
+        section("token_data"), integers("token_offsets"), integers("token_slots")
+    )
+    byte_offsets = integers("byte_offsets")
+    if len(byte_offsets) != len(tokens) + 1:
+        raise ValueError("Compiled encoder is damaged")
+    merges = StringTable(
+        section("merge_data"), integers("merge_offsets"), integers("merge_slots")
+    )
+    return Encoder(
+        encoder=tokens,
+        bpe_merges=None,
+        decoder=Slices(tokens.data, tokens.offsets, "utf-8"),
+        token_bytes=Slices(section("byte_data"), byte_offsets),
+        bpe_ranks=MergeRanks(merges),
+    )
@@ -49,19 +49,38 @@ def merge_states(x):
     return tf.reshape(x, start + [a * b])
 
 
+def scale_collection(name):
+    """Name of the graph collection for the scale of int8 weight name.
+
+    A custom getter that returns the weight unscaled adds its per-output-channel scale
+    there, and the layer using it scales the product instead.
+    """
+    return "scale:" + name
+
+
+def output_scale(name):
+    """What to multiply products with weight name by, or None."""
+    scales = tf.get_collection(scale_collection(name))
+    return scales[-1] if len(scales) > 0 else None
+
+
 def conv1d(x, scope, nf, *, w_init_stdev=0.02):
     with tf.variable_scope(scope):
         *start, nx = shape_list(x)
-        w = tf.get_variable(
-            "w",
-            [1, nx, nf],
-            initializer=tf.random_normal_initializer(stddev=w_init_stdev),
-        )
+        # Weights a custom getter computes on use (e.g. dequantizes) wait for x, so
+        # they aren't all materialized at once at the start of a step
+        with tf.control_dependencies([x]):
+            w = tf.get_variable(
+                "w",
+                [1, nx, nf],
+                initializer=tf.random_normal_initializer(stddev=w_init_stdev),
+            )
         b = tf.get_variable("b", [nf], initializer=tf.constant_initializer(0))
-        c = tf.reshape(
-            tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf])) + b,
-            start + [nf],
-        )
+        c = tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf]))
+        scale = output_scale(tf.get_variable_scope().name + "/w")
+        if scale is not None:
+            c = c * tf.reshape(scale, [nf])
+        c = tf.reshape(c + b, start + [nf])
         return c
 
 
@@ -76,7 +95,7 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def attn(x, scope, n_state, *, past, hparams, padding=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
@@ -97,6 +116,10 @@ def attn(x, scope, n_state, *, past, hparams):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if padding is not None:
+            # Nothing attends to the left padding of its row
+            keep = tf.range(ns)[None, None, None, :] >= padding[:, None, None, None]
+            b = b * tf.cast(keep, w.dtype)
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -132,10 +155,12 @@ def mlp(x, scope, n_state, *, hparams):
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, padding=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams)
+        a, present = attn(
+            norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams, padding=padding
+        )
         x = x + a
         m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
         x = x + m
@@ -160,13 +185,27 @@ def expand_tile(value, size):
     return tf.tile(tf.expand_dims(value, axis=0), [size] + [1] * ndims)
 
 
-def positions_for(tokens, past_length):
+def positions_for(tokens, past_length, padding=None):
     batch_size = tf.shape(tokens)[0]
     nsteps = tf.shape(tokens)[1]
-    return expand_tile(past_length + tf.range(nsteps), batch_size)
-
-
-def model(hparams, X, past=None, scope="model", reuse=False):
+    positions = expand_tile(past_length + tf.range(nsteps), batch_size)
+    if padding is not None:
+        # Every row counts positions from its first real token
+        positions = tf.maximum(positions - padding[:, None], 0)
+    return positions
+
+
+def model(
+    hparams, X, past=None, scope="model", reuse=False, last_logits=False, padding=None
+):
+    """Run the transformer over X.
+
+    With last_logits the vocabulary projection is only done for the last position,
+    which is all sampling needs; results["logits"] then has a sequence length of one.
+    Rows of different lengths are batched by left-padding them: padding ([batch]) is
+    the number of padding tokens at the start of each row of past followed by X. The
+    other tokens get the same results as they would without padding.
+    """
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -181,8 +220,12 @@ def model(hparams, X, past=None, scope="model", reuse=False):
             [hparams.n_vocab, hparams.n_embd],
             initializer=tf.random_normal_initializer(stddev=0.02),
         )
+        wte_scale = output_scale(tf.get_variable_scope().name + "/wte")
         past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        h = tf.gather(wte, X)
+        if wte_scale is not None:
+            h = h * tf.gather(wte_scale, X)
+        h = h + tf.gather(wpe, positions_for(X, past_length, padding))
 
         # Transformer
         presents = []
@@ -191,14 +234,21 @@ def model(hparams, X, past=None, scope="model", reuse=False):
         )
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, "h%d" % layer, past=past, hparams=hparams)
+            h, present = block(
+                h, "h%d" % layer, past=past, hparams=hparams, padding=padding
+            )
             presents.append(present)
         results["present"] = tf.stack(presents, axis=1)
         h = norm(h, "ln_f")
 
         # Language model loss.  Do tokens <n predict token n?
+        if last_logits:
+            h = h[:, -1:]
+            sequence = 1
         h_flat = tf.reshape(h, [batch * sequence, hparams.n_embd])
         logits = tf.matmul(h_flat, wte, transpose_b=True)
+        if wte_scale is not None:
+            logits = logits * tf.reshape(wte_scale, [hparams.n_vocab])
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results["logits"] = logits
         return results
@@ -0,0 +1,155 @@
+"""NumPy implementation of the forward pass in model.py.
+
+Weights are the arrays of an exported weights file (see weights.py), keyed by their
+checkpoint variable names. Keys and values live in an explicit cache that the caller
+allocates once and the model fills in place.
+"""
+
+import types
+
+import numpy as np
+from generator.gpt2.src.weights import matmul
+
+
+class HParams(types.SimpleNamespace):
+    def override_from_dict(self, values):
+        self.__dict__.update(values)
+        return self
+
+
+def default_hparams():
+    return HParams(n_vocab=0, n_ctx=1024, n_embd=768, n_head=12, n_layer=12,)
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def gelu(x):
+    # NumPy scalars would promote float32 activations to float64 under NumPy 2
+    c = np.float32(np.sqrt(2 / np.pi))
+    return 0.5 * x * (1 + np.tanh(c * (x + np.float32(0.044715) * np.power(x, 3))))
+
+
+def norm(x, weights, scope, *, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x - u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x * weights[scope + "/g"] + weights[scope + "/b"]
+
+
+def conv1d(x, weights, scope):
+    return matmul(x, weights, scope + "/w") + weights[scope + "/b"]
+
+
+def attention_mask(nd, ns):
+    """1's in the lower triangle, counting from the lower right corner."""
+    i = np.arange(nd)[:, None]
+    j = np.arange(ns)
+    return i >= j - ns + nd
+
+
+def attn(x, weights, scope, cache, past_length, *, hparams, padding=None):
+    # cache has shape [batch, 2, heads, sequence, features], where 2 is [k, v]
+    batch, sequence, n_state = x.shape
+    n_head = hparams.n_head
+
+    def split_heads(x):
+        # From [batch, sequence, features] to [batch, heads, sequence, features]
+        return x.reshape(batch, sequence, n_head, -1).transpose(0, 2, 1, 3)
+
+    def merge_heads(x):
+        # Reverse of split_heads
+        return x.transpose(0, 2, 1, 3).reshape(batch, sequence, n_state)
+
+    c = conv1d(x, weights, scope + "/c_attn")
+    q, k, v = map(split_heads, np.split(c, 3, axis=2))
+    end = past_length + sequence
+    cache[:, 0, :, past_length:end] = k
+    cache[:, 1, :, past_length:end] = v
+    k = cache[:, 0, :, :end]
+    v = cache[:, 1, :, :end]
+
+    w = np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(np.float32(v.shape[-1]))
+    mask = attention_mask(sequence, end)
+    if padding is not None:
+        # Nothing attends to the left padding of its row
+        mask = mask & (np.arange(end)[None, None, None, :] >= padding[:, None, None, None])
+    w = np.where(mask, w, np.float32(-1e10))
+    a = np.matmul(softmax(w), v)
+    return conv1d(merge_heads(a), weights, scope + "/c_proj")
+
+
+def mlp(x, weights, scope):
+    h = gelu(conv1d(x, weights, scope + "/c_fc"))
+    return conv1d(h, weights, scope + "/c_proj")
+
+
+def block(x, weights, scope, cache, past_length, *, hparams, padding=None):
+    x = x + attn(
+        norm(x, weights, scope + "/ln_1"), weights, scope + "/attn", cache, past_length,
+        hparams=hparams, padding=padding,
+    )
+    return x + mlp(norm(x, weights, scope + "/ln_2"), weights, scope + "/mlp")
+
+
+def past_shape(*, hparams, batch_size=None, sequence=None):
+    return [
+        batch_size,
+        hparams.n_layer,
+        2,
+        hparams.n_head,
+        sequence,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def embed(weights, X):
+    wte = weights["model/wte"]
+    h = wte[X].astype(np.float32)
+    if "model/wte/scale" in weights:
+        h *= weights["model/wte/scale"][X]
+    return h
+
+
+def model(hparams, weights, X, cache=None, past_length=0, last_logits=False, padding=None):
+    """Run the model over tokens X ([batch, sequence]) following past_length cached ones.
+
+    cache holds at least past_length + sequence positions; the keys/values of X are
+    written after the first past_length. Returns the logits and the keys/values of X
+    ("present", a view into cache). With last_logits only the last position is
+    projected onto the vocabulary. padding is the left padding of every row, as in
+    model.model.
+    """
+    X = np.asarray(X)
+    batch, sequence = X.shape
+    if cache is None:
+        cache = np.zeros(
+            past_shape(hparams=hparams, batch_size=batch, sequence=past_length + sequence),
+            dtype=np.float32,
+        )
+    positions = past_length + np.arange(sequence)[None, :]
+    if padding is not None:
+        padding = np.asarray(padding)
+        positions = np.maximum(positions - padding[:, None], 0)
+    h = embed(weights, X) + weights["model/wpe"][positions]
+
+    # Transformer
+    for layer in range(hparams.n_layer):
+        h = block(
+            h, weights, "model/h%d" % layer, cache[:, layer], past_length,
+            hparams=hparams, padding=padding,
+        )
+    h = norm(h, weights, "model/ln_f")
+    if last_logits:
+        h = h[:, -1:]
+
+    # Language model loss.  Do tokens <n predict token n?
+    logits = matmul(h, weights, "model/wte", transpose=True)
+    return {
+        "logits": logits,
+        "present": cache[..., past_length : past_length + sequence, :],
+    }
@@ -0,0 +1,374 @@
+"""NumPy implementation of the sampling loop in sample.py."""
+
+import time
+
+import numpy as np
+from generator.gpt2.src import np_model
+
+
+def token_counts(tokens, n_vocab):
+    """How often every token of the vocabulary occurs in each row of tokens (ignoring -1)."""
+    counts = np.zeros((tokens.shape[0], n_vocab + 1), dtype=np.int32)
+    rows = np.repeat(np.arange(tokens.shape[0]), tokens.shape[1])
+    # -1 is counted in the extra last column
+    np.add.at(counts, (rows, tokens.reshape(-1)), 1)
+    return counts[:, :n_vocab]
+
+
+def penalize_used(logits, counts, penalty=0.85):
+    # Change the logits of every token that was used in the same row of the batch
+    return np.where(counts > 0, logits * penalty, logits)
+
+
+def top_p_logits(logits, p, candidates=0):
+    """Nucleus sampling, see sample.top_p_logits"""
+    batch, num = logits.shape
+    p = np.reshape(np.asarray(p, dtype=logits.dtype), (-1, 1))
+
+    def min_values(sorted_logits, cumulative_probs):
+        # number of indices to include
+        included = np.minimum(np.sum(cumulative_probs < p, axis=-1), sorted_logits.shape[1] - 1)
+        return sorted_logits[np.arange(batch), included][:, None]
+
+    cutoff = None
+    if 0 < candidates < num:
+        top_logits = np.partition(logits, num - candidates, axis=-1)[:, num - candidates :]
+        top_logits = -np.sort(-top_logits, axis=-1)
+        # log of the softmax denominator over the whole vocabulary
+        log_total = top_logits[:, :1] + np.log(
+            np.sum(np.exp(logits - top_logits[:, :1]), axis=-1, keepdims=True)
+        )
+        top_cumulative = np.cumsum(np.exp(top_logits - log_total), axis=-1)
+        if (top_cumulative[:, -1:] >= p).all():
+            cutoff = min_values(top_logits, top_cumulative)
+    if cutoff is None:
+        sorted_logits = -np.sort(-logits, axis=-1)
+        cutoff = min_values(sorted_logits, np.cumsum(np_model.softmax(sorted_logits), axis=-1))
+    return np.where(logits < cutoff, np.float32(-1e10), logits)
+
+
+def multinomial(logits, rng):
+    """Draw one token per row from softmax(logits)."""
+    return draw(np_model.softmax(logits.astype(np.float64)), rng)
+
+
+def draw(probabilities, rng):
+    """Draw one token per row from (not necessarily normalized) probabilities."""
+    cumulative = np.cumsum(probabilities, axis=-1)
+    draws = rng.random_sample((probabilities.shape[0], 1)) * cumulative[:, -1:]
+    return np.minimum(np.sum(cumulative <= draws, axis=-1), probabilities.shape[1] - 1)
+
+
+def sample_sequence(
+    *,
+    hparams,
+    weights,
+    length,
+    context,
+    past=None,
+    past_tokens=None,
+    temperature=1,
+    top_p=1,
+    penalty=0.85,
+    penalty_window=0,
+    nucleus_candidates=0,
+    padding=None,
+    stop_tokens=None,
+    sentence_tokens=None,
+    max_sentences=0,
+    end_token=None,
+    rng=np.random,
+    deadline=None,
+):
+    """Same as sample.sample_sequence, but returns numpy arrays.
+
+    All keys/values go into one cache allocated up front for the longest possible
+    output, so no step copies the past. Raises TimeoutError if a step would start
+    after deadline (a time.time() value).
+    """
+    context = np.asarray(context, dtype=np.int32)
+    batch = context.shape[0]
+    if past is None:
+        past = np.zeros(
+            np_model.past_shape(hparams=hparams, batch_size=batch, sequence=0),
+            dtype=np.float32,
+        )
+    if past_tokens is None:
+        past_tokens = context[:, :0]
+    past_tokens = np.asarray(past_tokens, dtype=np.int32).reshape(batch, -1)
+
+    past_length = past.shape[-2]
+    cache = np.empty(
+        np_model.past_shape(
+            hparams=hparams,
+            batch_size=batch,
+            sequence=past_length + context.shape[1] + length - 1,
+        ),
+        dtype=np.float32,
+    )
+    cache[..., :past_length, :] = past
+
+    # Token counts for the repetition penalty, updated with every sampled token
+    history = np.concatenate([past_tokens, context], axis=1)
+    if padding is not None:
+        padding = np.asarray(padding, dtype=np.int32)
+        history = np.where(np.arange(history.shape[1]) < padding[:, None], -1, history)
+    if penalty_window > 0:
+        history = history[:, -penalty_window:]
+    counts = token_counts(history, hparams.n_vocab)
+    rows = np.arange(batch)
+
+    output = context
+    prev = context
+    done = np.zeros(batch, dtype=bool)
+    sentences = np.zeros(batch, dtype=np.int32)
+    for i in range(length):
+        if i > 0 and done.all():
+            break
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError("Generation deadline passed")
+        logits = np_model.model(
+            hparams, weights, prev, cache, past_length, last_logits=True, padding=padding
+        )["logits"]
+        past_length += prev.shape[1]
+        if i == 0:
+            context_length = past_length
+
+        logits = logits[:, -1, :] / np.reshape(np.asarray(temperature, np.float32), (-1, 1))
+        logits = penalize_used(logits, counts, penalty=penalty)
+        logits = top_p_logits(logits, p=top_p, candidates=nucleus_candidates)
+        token = multinomial(logits, rng).astype(np.int32)
+        if stop_tokens is not None:
+            token = np.where(done, end_token, token).astype(np.int32)
+            sentences += sentence_tokens[token]
+            done |= stop_tokens[token]
+            if max_sentences > 0:
+                done |= sentences >= max_sentences
+        prev = token[:, None]
+        output = np.concatenate([output, prev], axis=1)
+        counts[rows, token] += 1
+        leaving = past_tokens.shape[1] + output.shape[1] - 1 - penalty_window
+        if penalty_window > 0 and leaving >= 0:
+            if leaving < past_tokens.shape[1]:
+                left = past_tokens[:, leaving]
+            else:
+                left = output[:, leaving - past_tokens.shape[1]]
+            # Padding was never counted
+            counted = np.ones(batch, dtype=bool) if padding is None else leaving >= padding
+            counts[rows[counted], left[counted]] -= 1
+
+    return {
+        "tokens": output,
+        "context_past": cache[..., :context_length, :],
+        "past": cache[..., :past_length, :],
+    }
+
+
+class DraftModel:
+    """A smaller model with the same vocabulary that guesses the next tokens.
+
+    It keeps its own keys/values; those of guesses that didn't make it into the
+    history are recomputed on the next call.
+    """
+
+    def __init__(self, hparams, weights, past, past_tokens, sequence):
+        self.hparams = hparams
+        self.weights = weights
+        self.cache = np.empty(
+            np_model.past_shape(hparams=hparams, batch_size=1, sequence=sequence),
+            dtype=np.float32,
+        )
+        self.cache[..., : past.shape[-2], :] = past
+        # Tokens whose keys/values are in the cache, and how many of them are known
+        # to match the history
+        self.tokens = [int(token) for token in past_tokens]
+        self.checked = len(self.tokens)
+
+    def propose(self, history, count, distribution, rng):
+        """Sample count tokens to follow history; returns them and their probabilities."""
+        valid = min(self.checked, len(self.tokens))
+        limit = min(len(self.tokens), len(history))
+        while valid < limit and self.tokens[valid] == history[valid]:
+            valid += 1
+        # The last token always runs, for the logits after it
+        valid = min(valid, len(history) - 1)
+        del self.tokens[valid:]
+        self.checked = len(history)
+
+        sequence = list(history)
+        feed = history[valid:]
+        probabilities = []
+        for _ in range(count):
+            logits = np_model.model(
+                self.hparams,
+                self.weights,
+                np.array([feed], dtype=np.int32),
+                self.cache,
+                len(self.tokens),
+                last_logits=True,
+            )["logits"][:, -1]
+            self.tokens.extend(feed)
+            q = distribution(logits, sequence, [len(sequence)])
+            feed = [int(draw(q, rng)[0])]
+            sequence.extend(feed)
+            probabilities.append(q[0])
+        return sequence[len(history) :], probabilities
+
+
+class PromptLookup:
+    """Guesses that the text continues like it did after the last few tokens before.
+
+    Stories keep repeating names, places and phrases of the context, so the tokens
+    that followed the most recent earlier occurrence of the last max_ngram (or fewer)
+    tokens are proposed, with probability 1. This needs no second model.
+    """
+
+    def __init__(self, n_vocab, max_ngram=3):
+        self.n_vocab = n_vocab
+        self.max_ngram = max_ngram
+
+    def propose(self, history, count, distribution, rng):
+        tokens = np.asarray(history)
+        for size in range(min(self.max_ngram, len(tokens) - 1), 0, -1):
+            starts = np.arange(len(tokens) - size)
+            found = np.ones(len(starts), dtype=bool)
+            for i in range(size):
+                found &= tokens[starts + i] == tokens[len(tokens) - size + i]
+            found = np.flatnonzero(found)
+            if len(found) > 0:
+                start = found[-1] + size
+                proposal = [int(token) for token in tokens[start : start + count]]
+                probabilities = np.zeros((len(proposal), self.n_vocab))
+                probabilities[np.arange(len(proposal)), proposal] = 1
+                return proposal, probabilities
+        return [], []
+
+
+def speculative_sample_sequence(
+    *,
+    hparams,
+    weights,
+    drafter,
+    draft_tokens=4,
+    length,
+    context,
+    past=None,
+    past_tokens=None,
+    temperature=1,
+    top_p=1,
+    penalty=0.85,
+    penalty_window=0,
+    nucleus_candidates=0,
+    stop_tokens=None,
+    sentence_tokens=None,
+    max_sentences=0,
+    end_token=None,
+    rng=np.random,
+    deadline=None,
+):
+    """sample_sequence for a batch of one, running the model over drafted tokens.
+
+    Every round drafter proposes up to draft_tokens tokens and the model runs over all
+    of them at once, which costs about as much as one step. Each draft is kept with
+    probability min(1, p/q) of the model's and the drafter's probabilities for it;
+    the first one that isn't is replaced by a draw from max(p - q, 0) and the round
+    ends there. This is speculative sampling, so the tokens have exactly the
+    distribution sample_sequence would draw them from, penalty and top_p included.
+    The results also count the "drafted" and "accepted" tokens.
+    """
+    context = np.asarray(context, dtype=np.int32).reshape(-1)
+    if past is None:
+        past = np.zeros(
+            np_model.past_shape(hparams=hparams, batch_size=1, sequence=0),
+            dtype=np.float32,
+        )
+    if past_tokens is None:
+        past_tokens = context[:0]
+    history = [int(token) for token in np.asarray(past_tokens).reshape(-1)]
+    history += [int(token) for token in context]
+    context_length = len(history)
+    temperature = np.float32(np.asarray(temperature).reshape(-1)[0])
+
+    def distribution(logits, sequence, ends):
+        """What sample_sequence would draw the token at each of ends from."""
+        counts = np.zeros((len(ends), hparams.n_vocab), dtype=np.int32)
+        for row, end in enumerate(ends):
+            start = max(end - penalty_window, 0) if penalty_window > 0 else 0
+            counts[row] = np.bincount(sequence[start:end], minlength=hparams.n_vocab)
+        logits = penalize_used(logits / temperature, counts, penalty=penalty)
+        logits = top_p_logits(logits, p=top_p, candidates=nucleus_candidates)
+        return np_model.softmax(logits.astype(np.float64))
+
+    # The model has run over all of history but its last token
+    cache = np.empty(
+        np_model.past_shape(
+            hparams=hparams, batch_size=1, sequence=context_length + length
+        ),
+        dtype=np.float32,
+    )
+    past_length = past.shape[-2]
+    cache[..., :past_length, :] = past
+    if past_length < context_length - 1:
+        np_model.model(
+            hparams,
+            weights,
+            np.array([history[past_length:-1]], dtype=np.int32),
+            cache,
+            past_length,
+            last_logits=True,
+        )
+    past_length = context_length - 1
+
+    done = False
+    sentences = 0
+    drafted = accepted = 0
+    while len(history) < context_length + length and not done:
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError("Generation deadline passed")
+        # A round adds at most one token more than it drafts
+        count = min(draft_tokens, context_length + length - len(history) - 1)
+        drafts, q = [], []
+        if count > 0:
+            drafts, q = drafter.propose(history, count, distribution, rng)
+        logits = np_model.model(
+            hparams,
+            weights,
+            np.array([history[-1:] + drafts], dtype=np.int32),
+            cache,
+            past_length,
+        )["logits"][0]
+        sequence = history + drafts
+        p = distribution(logits, sequence, range(len(history), len(sequence) + 1))
+
+        new = []
+        for i, token in enumerate(drafts):
+            if rng.random_sample() * q[i][token] < p[i][token]:
+                new.append(token)
+                continue
+            residual = np.maximum(p[i] - q[i], 0)
+            if residual.sum() <= 0:
+                residual = p[i]
+            new.append(int(draw(residual[None], rng)[0]))
+            break
+        else:
+            new.append(int(draw(p[len(drafts)][None], rng)[0]))
+        drafted += len(drafts)
+        accepted += len(new) - 1
+
+        for token in new:
+            history.append(token)
+            if stop_tokens is not None:
+                sentences += int(sentence_tokens[token])
+                done = bool(stop_tokens[token]) or 0 < max_sentences <= sentences
+                if done:
+                    break
+        # The model ran over the last token and the accepted drafts
+        past_length = min(past_length + len(new), len(history) - 1)
+
+    return {
+        "tokens": np.array([history[context_length - len(context) :]], dtype=np.int32),
+        "context_past": cache[..., :context_length, :],
+        "past": cache[..., :past_length, :],
+        "drafted": drafted,
+        "accepted": accepted,
+    }
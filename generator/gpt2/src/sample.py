@@ -1,20 +1,46 @@
 import tensorflow as tf
 from generator.gpt2.src import model
+from generator.gpt2.src.model import shape_list
 
 
-def penalize_used(logits, output):
+def token_counts(tokens, n_vocab):
+    """How often every token of the vocabulary occurs in each row of tokens (ignoring -1)."""
+    rows = tf.tile(tf.range(tf.shape(tokens)[0])[:, None], [1, tf.shape(tokens)[1]])
+    indices = tf.stack([rows, tf.maximum(tokens, 0)], axis=-1)
+    updates = tf.cast(tokens >= 0, tf.int32)
+    return tf.scatter_nd(indices, updates, [tf.shape(tokens)[0], n_vocab])
 
-    # I want to change the indices of logits wherever the index is found in output
-    change_tensor = tf.zeros_like(logits, dtype=logits.dtype)
-    unique = tf.unique(output[0])[0]
-    ones = tf.ones_like(unique, dtype=unique.dtype)
-    indices = tf.expand_dims(unique, 1)
 
-    updates = tf.scatter_nd(indices, ones, [logits.shape[1]])
+def penalty_state(tokens, n_vocab, window=0):
+    """Initial state of the repetition penalty for the tokens so far.
 
-    bool_tensor = tf.expand_dims(tf.cast(updates, tf.bool), 0)
+    Returns the counts of the tokens the penalty applies to (the last window of them,
+    or all when window is 0) and those last window tokens, left-padded with -1, so
+    update_penalty_state knows which token drops out of the window. Padding tokens
+    should already be replaced by -1.
+    """
+    batch, length = shape_list(tokens)
+    start = tf.compat.v1.where(window > 0, tf.maximum(length - window, 0), 0)
+    counted = tokens[:, start:]
+    filler = tf.fill([batch, tf.maximum(window - (length - start), 0)], -1)
+    recent = tf.concat([filler, counted], axis=1)[:, :window]
+    return token_counts(counted, n_vocab), recent
 
-    return tf.compat.v1.where(bool_tensor, logits * 0.85, logits)
+
+def update_penalty_state(counts, recent, token, window=0):
+    """Add token to the penalty state; the cost doesn't depend on the sequence length."""
+    recent = tf.concat([recent, token[:, None]], axis=1)
+    # one_hot of -1 is all zeros, so padding and an unbounded window remove nothing
+    leaving = tf.compat.v1.where(window > 0, recent[:, 0], -tf.ones_like(token))
+    n_vocab = shape_list(counts)[1]
+    counts = counts + tf.one_hot(token, n_vocab, dtype=tf.int32)
+    counts = counts - tf.one_hot(leaving, n_vocab, dtype=tf.int32)
+    return counts, recent[:, 1:]
+
+
+def penalize_used(logits, counts, penalty=0.85):
+    # Change the logits of every token that was used in the same row of the batch
+    return tf.compat.v1.where(counts > 0, logits * penalty, logits)
 
 
 def top_k_logits(logits, k):
@@ -34,21 +60,34 @@ def top_k_logits(logits, k):
     return tf.cond(tf.equal(k, 0), lambda: logits, lambda: _top_k(),)
 
 
-def top_p_logits(logits, p):
-    """Nucleus sampling"""
-    batch, num = logits.shape.as_list()
-    sorted_logits = tf.sort(logits, direction="DESCENDING", axis=-1)
-    cumulative_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
-    indices = tf.stack(
-        [
-            tf.range(0, batch),
-            # number of indices to include
-            tf.minimum(tf.reduce_sum(tf.cast(cumulative_probs < p, tf.int32), axis=-1), num),
-        ],
-        axis=-1,
-    )
-    min_values = tf.gather_nd(sorted_logits, indices)
-    return tf.where(logits < min_values, tf.ones_like(logits) * -1e10, logits,)
+def top_p_logits(logits, p, candidates=0):
+    """Nucleus sampling
+
+    With candidates > 0 the nucleus is first looked for among that many of the most
+    likely tokens, which avoids sorting the whole vocabulary. The cutoff is the same
+    as long as the nucleus fits in them; when it doesn't the full sort is used.
+    p is a scalar or one value per row.
+    """
+    batch, num = shape_list(logits)
+    p = tf.reshape(tf.cast(p, logits.dtype), [-1, 1])
+
+    def min_values(sorted_logits, cumulative_probs):
+        # number of indices to include
+        included = tf.reduce_sum(tf.cast(cumulative_probs < p, tf.int32), axis=-1)
+        included = tf.minimum(included, tf.shape(sorted_logits)[1] - 1)
+        return tf.gather_nd(sorted_logits, tf.stack([tf.range(0, batch), included], axis=-1))
+
+    def exact():
+        sorted_logits = tf.sort(logits, direction="DESCENDING", axis=-1)
+        cumulative_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
+        return min_values(sorted_logits, cumulative_probs)
+
+    top_logits, _ = tf.nn.top_k(logits, k=tf.clip_by_value(candidates, 1, num))
+    top_probs = tf.exp(top_logits - tf.reduce_logsumexp(logits, axis=-1, keepdims=True))
+    top_cumulative = tf.cumsum(top_probs, axis=-1)
+    fits = tf.logical_and(candidates > 0, tf.reduce_all(top_cumulative[:, -1:] >= p))
+    cutoff = tf.cond(fits, lambda: min_values(top_logits, top_cumulative), exact)
+    return tf.where(logits < cutoff[:, None], tf.ones_like(logits) * -1e10, logits,)
 
 
 def sample_sequence(
@@ -58,19 +97,50 @@ def sample_sequence(
     start_token=None,
     batch_size=None,
     context=None,
+    past=None,
+    past_tokens=None,
     temperature=1,
     #top_k=0,
     top_p=1,
+    penalty=0.85,
+    penalty_window=0,
+    nucleus_candidates=0,
+    padding=None,
+    stop_tokens=None,
+    sentence_tokens=None,
+    max_sentences=0,
+    end_token=None,
 ):
+    """Sample up to length tokens after context.
+
+    Decoding stops early once every row has sampled one of stop_tokens (a boolean mask
+    over the vocabulary) or, when max_sentences is positive, that many of
+    sentence_tokens. Rows that finish before the others are padded with end_token.
+    The repetition penalty applies to the last penalty_window tokens, or all of them
+    when it is 0. nucleus_candidates bounds the top_p search, see top_p_logits.
+    temperature and top_p are scalars or one value per row.
+    padding is the left padding of each row of past_tokens followed by context, as
+    in model.model; padding tokens are ignored by the repetition penalty.
+    """
     if start_token is None:
         assert context is not None, "Specify exactly one of start_token and context!"
     else:
         assert context is None, "Specify exactly one of start_token and context!"
         context = tf.fill([batch_size, 1], start_token)
 
+    # past holds the keys/values of tokens already run through the model on a previous
+    # call; past_tokens are those tokens, which still count towards the repetition penalty.
+    if past_tokens is None:
+        past_tokens = context[:, :0]
+
     def step(hparams, tokens, past=None):
         lm_output = model.model(
-            hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE
+            hparams=hparams,
+            X=tokens,
+            past=past,
+            reuse=tf.AUTO_REUSE,
+            last_logits=True,
+            padding=padding,
         )
 
         logits = lm_output["logits"][:, :, : hparams.n_vocab]
@@ -83,39 +153,81 @@ def sample_sequence(
 
     with tf.name_scope("sample_sequence"):
 
-        def body(past, prev, output):
+        def body(past, prev, output, done, sentences, counts, recent):
             next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
-            logits = penalize_used(logits, output)
+            logits = next_outputs["logits"][:, -1, :] / tf.reshape(
+                tf.to_float(temperature), [-1, 1]
+            )
+            logits = penalize_used(logits, counts, penalty=penalty)
             #logits = top_k_logits(logits, k=top_k)
-            logits = top_p_logits(logits, p=top_p)
+            logits = top_p_logits(logits, p=top_p, candidates=nucleus_candidates)
             samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+            if stop_tokens is not None:
+                token = tf.compat.v1.where(done, tf.fill(tf.shape(done), end_token), samples[:, 0])
+                sentences = sentences + tf.cast(tf.gather(sentence_tokens, token), tf.int32)
+                done = tf.logical_or(done, tf.gather(stop_tokens, token))
+                done = tf.logical_or(
+                    done, tf.logical_and(max_sentences > 0, sentences >= max_sentences)
+                )
+                samples = token[:, None]
+            counts, recent = update_penalty_state(
+                counts, recent, samples[:, 0], window=penalty_window
+            )
             return [
                 next_outputs["presents"]
                 if past is None
                 else tf.concat([past, next_outputs["presents"]], axis=-2),
                 samples,
                 tf.concat([output, samples], axis=1),
+                done,
+                sentences,
+                counts,
+                recent,
             ]
 
-        past, prev, output = body(None, context, context)
+        batch = tf.shape(context)[0]
+        history = tf.concat([past_tokens, context], axis=1)
+        if padding is not None:
+            columns = tf.range(tf.shape(history)[1])[None, :]
+            history = tf.compat.v1.where(
+                columns < padding[:, None], -tf.ones_like(history), history
+            )
+        counts, recent = penalty_state(history, hparams.n_vocab, window=penalty_window)
+        past, prev, output, done, sentences, counts, recent = body(
+            past,
+            context,
+            context,
+            tf.zeros([batch], dtype=tf.bool),
+            tf.zeros([batch], dtype=tf.int32),
+            counts,
+            recent,
+        )
+        context_past = past
 
-        def cond(*args):
-            return True
+        def cond(past, prev, output, done, sentences, counts, recent):
+            return tf.logical_not(tf.reduce_all(done))
 
-        _, _, tokens = tf.while_loop(
+        past, _, tokens, _, _, _, _ = tf.while_loop(
             cond=cond,
             body=body,
             maximum_iterations=length - 1,
-            loop_vars=[past, prev, output],
+            loop_vars=[past, prev, output, done, sentences, counts, recent],
             shape_invariants=[
                 tf.TensorShape(
                     model.past_shape(hparams=hparams, batch_size=batch_size)
                 ),
                 tf.TensorShape([batch_size, None]),
                 tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size, hparams.n_vocab]),
+                tf.TensorShape([batch_size, None]),
             ],
             back_prop=False,
         )
 
-        return tokens
+        return {
+            "tokens": tokens,
+            "context_past": context_past,
+            "past": past,
+        }
@@ -0,0 +1,151 @@
+"""Flat, memory-mappable storage for model weights.
+
+A weights file is an 8 byte little-endian header length, a JSON header describing
+every array, and the raw array data. Arrays start on 64 byte boundaries so they can
+be used straight from the memory map, and processes mapping the same file share
+the pages holding it.
+"""
+
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+ALIGNMENT = 64
+WEIGHTS_FILE = "model.weights"
+QUANTIZATIONS = ("int8", "float16")
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save(path, arrays, metadata=None):
+    """Write a dict of name -> numpy array to path."""
+    header = {"metadata": metadata or {}, "arrays": {}}
+    offset = 0
+    for name in sorted(arrays):
+        array = np.asarray(arrays[name], order="C")
+        header["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = align(8 + len(header_bytes))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name in sorted(arrays):
+            array = np.asarray(arrays[name], order="C")
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(length).decode("utf-8")), align(8 + length)
+
+
+def load(path):
+    """Map the arrays in path into memory without reading them.
+
+    Returns a dict of name -> read-only array and the metadata saved with them.
+    """
+    header, data_start = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        start = data_start + info["offset"]
+        arrays[name] = (
+            data[start : start + count * dtype.itemsize].view(dtype).reshape(info["shape"])
+        )
+    return arrays, header["metadata"]
+
+
+def weights_file(quantization=None):
+    if quantization is None:
+        return WEIGHTS_FILE
+    return "model." + quantization + ".weights"
+
+
+def is_matmul_weight(name):
+    """Weights of the big matmuls: attention/MLP projections and the tied wte."""
+    return name == "model/wte" or name.endswith(("/c_attn/w", "/c_proj/w", "/c_fc/w"))
+
+
+def quantize(arrays, quantization):
+    """Convert the matmul weights in arrays to int8 or float16.
+
+    int8 weights get a float32 "<name>/scale" per output channel (the last axis of the
+    conv1d weights, the vocabulary axis of wte) such that weight ~= int8 * scale.
+    """
+    assert quantization in QUANTIZATIONS, "Unknown quantization " + str(quantization)
+    quantized = {}
+    for name, array in arrays.items():
+        if not is_matmul_weight(name):
+            quantized[name] = array
+        elif quantization == "float16":
+            quantized[name] = array.astype(np.float16)
+        else:
+            axes = (1,) if name == "model/wte" else tuple(range(array.ndim - 1))
+            scale = np.abs(array).max(axis=axes, keepdims=True) / 127
+            scale[scale == 0] = 1
+            quantized[name] = np.clip(np.round(array / scale), -127, 127).astype(np.int8)
+            quantized[name + "/scale"] = scale.astype(np.float32)
+    return quantized
+
+
+def matmul(x, arrays, name, transpose=False):
+    """x times the last two axes of weight name (transposed), whatever its form.
+
+    The scale of int8 weights is per output channel, so it is applied to the product
+    rather than to a copy of the weight. Quantized weights are still converted to
+    float32 for every product, which costs more than reading float32 weights would.
+    """
+    w = arrays[name]
+    w = w.reshape(w.shape[-2:]).astype(np.float32, copy=False)
+    product = np.matmul(x, w.T if transpose else w)
+    if name + "/scale" in arrays:
+        product *= arrays[name + "/scale"].reshape(-1)
+    return product
+
+
+def checkpoint_name(checkpoint):
+    return None if checkpoint is None else os.path.basename(checkpoint)
+
+
+def latest_checkpoint(model_path):
+    """The checkpoint tf.train.latest_checkpoint would find, without TensorFlow."""
+    try:
+        with open(os.path.join(model_path, "checkpoint"), "r") as f:
+            state = f.read()
+    except OSError:
+        return None
+    match = re.search(r'^model_checkpoint_path:\s*"(.*)"', state, re.MULTILINE)
+    if match is None:
+        return None
+    checkpoint = os.path.join(model_path, match.group(1))
+    if not (os.path.isfile(checkpoint + ".index") or os.path.isfile(checkpoint)):
+        return None
+    return checkpoint
+
+
+def is_current(path, checkpoint):
+    """Whether path exists and was exported from checkpoint (if there is one)."""
+    if not os.path.isfile(path):
+        return False
+    if checkpoint is None:
+        return True
+    header, _ = read_header(path)
+    return header["metadata"].get("checkpoint") == checkpoint_name(checkpoint)
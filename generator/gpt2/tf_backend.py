@@ -0,0 +1,158 @@
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from generator.gpt2.src import model, sample, weights
+
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+class TFBackend:
+    """Runs sample.sample_sequence in a TensorFlow session."""
+
+    def __init__(self, hparams, model_path, quantization=None, sentence_tokens=None, end_token=None):
+        self.hparams = hparams
+        self.sentence_tokens = sentence_tokens
+        self.end_token = end_token
+
+        config = tf.compat.v1.ConfigProto()
+        config.gpu_options.allow_growth = True
+        self.sess = tf.compat.v1.Session(config=config)
+
+        self.context = tf.placeholder(tf.int32, [None, None])
+        self.past = tf.placeholder(tf.float32, model.past_shape(hparams=self.hparams))
+        self.past_tokens = tf.placeholder(tf.int32, [None, None])
+        # Sampling settings are fed on every run so changing them doesn't rebuild the graph.
+        self.length_ph = tf.placeholder(tf.int32, [])
+        # Scalars, or one value per row of the batch
+        self.temp_ph = tf.placeholder(tf.float32, None)
+        self.top_p_ph = tf.placeholder(tf.float32, None)
+        self.penalty_ph = tf.placeholder(tf.float32, [])
+        self.penalty_window_ph = tf.placeholder(tf.int32, [])
+        self.nucleus_candidates_ph = tf.placeholder(tf.int32, [])
+        # Left padding of each row, for batches of prompts with different lengths
+        self.padding_ph = tf.placeholder(tf.int32, [None])
+        self.max_sentences_ph = tf.placeholder(tf.int32, [])
+        self.stop_tokens_ph = tf.placeholder(tf.bool, [self.hparams.n_vocab])
+        # np.random.seed(seed)
+        # tf.set_random_seed(seed)
+
+        # An exported weights file is memory-mapped and fed to the graph in place of
+        # variables, which skips restoring the checkpoint and lets processes share it.
+        # Quantized (int8 or float16) files only exist in that form.
+        ckpt = tf.train.latest_checkpoint(model_path)
+        weights_path = os.path.join(model_path, weights.weights_file(quantization))
+        self.weight_feeds = {}
+        self.weight_getter = None
+        if quantization is not None and not weights.is_current(weights_path, ckpt):
+            raise FileNotFoundError(
+                "No up to date " + quantization + " weights; run python -m "
+                "generator.gpt2.quantize " + os.path.basename(model_path) + " " + quantization
+            )
+        if weights.is_current(weights_path, ckpt):
+            arrays, _ = weights.load(weights_path)
+            placeholders = {
+                name: tf.placeholder(array.dtype, array.shape) for name, array in arrays.items()
+            }
+            self.weight_feeds = {placeholders[name]: arrays[name] for name in arrays}
+
+            def weight_getter(getter, name, *args, **kwargs):
+                # Quantized weights are expanded to float32 where they are used, so only
+                # one matmul's worth is ever held in float32. The int8 scale is applied
+                # to the product instead, see model.output_scale.
+                if name + "/scale" in placeholders:
+                    tf.add_to_collection(
+                        model.scale_collection(name), placeholders[name + "/scale"]
+                    )
+                return tf.cast(placeholders[name], tf.float32)
+
+            self.weight_getter = weight_getter
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=weight_getter):
+                self.gen_output()
+        else:
+            self.gen_output()
+            self.saver = tf.train.Saver()
+            self.saver.restore(self.sess, ckpt)
+
+    def gen_output(self):
+        self.output = sample.sample_sequence(
+            hparams=self.hparams,
+            length=self.length_ph,
+            context=self.context,
+            past=self.past,
+            past_tokens=self.past_tokens,
+            temperature=self.temp_ph,
+            #top_k=self.top_k,
+            top_p=self.top_p_ph,
+            penalty=self.penalty_ph,
+            penalty_window=self.penalty_window_ph,
+            nucleus_candidates=self.nucleus_candidates_ph,
+            padding=self.padding_ph,
+            stop_tokens=self.stop_tokens_ph,
+            sentence_tokens=tf.constant(self.sentence_tokens),
+            max_sentences=self.max_sentences_ph,
+            end_token=self.end_token,
+        )
+
+    def sample(
+        self,
+        context,
+        past,
+        past_tokens,
+        *,
+        length,
+        temperature,
+        top_p,
+        penalty,
+        penalty_window,
+        nucleus_candidates,
+        stop_tokens,
+        max_sentences,
+        padding=None,
+        deadline=None,
+        context_past=True,
+        keep_past=True,
+    ):
+        """Run the sampling loop; returns the tokens and the past as numpy arrays.
+
+        context_past=False skips fetching the past of the context, and keep_past=False
+        the past of everything sampled, when the caller doesn't need it. A run still
+        going at deadline (a time.time() value) is cancelled by TensorFlow and raises
+        TimeoutError.
+        """
+        fetches = {"tokens": self.output["tokens"]}
+        if keep_past:
+            fetches["past"] = self.output["past"]
+        if context_past:
+            fetches["context_past"] = self.output["context_past"]
+        if padding is None:
+            padding = np.zeros(len(context), dtype=np.int32)
+        options = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Generation deadline passed")
+            options = tf.compat.v1.RunOptions(timeout_in_ms=max(1, int(remaining * 1000)))
+        try:
+            return self.sess.run(
+                fetches,
+                feed_dict={
+                    **self.weight_feeds,
+                    self.context: context,
+                    self.past: past,
+                    self.past_tokens: past_tokens,
+                    self.length_ph: length,
+                    self.temp_ph: temperature,
+                    self.top_p_ph: top_p,
+                    self.penalty_ph: penalty,
+                    self.penalty_window_ph: penalty_window,
+                    self.nucleus_candidates_ph: nucleus_candidates,
+                    self.padding_ph: padding,
+                    self.max_sentences_ph: max_sentences,
+                    self.stop_tokens_ph: stop_tokens,
+                },
+                options=options,
+            )
+        except tf.errors.DeadlineExceededError:
+            raise TimeoutError("Generation deadline passed")
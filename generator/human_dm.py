@@ -2,5 +2,8 @@ from story.utils import *
 
 
 class HumanDM:
-    def generate(self, prompt, options=None, seed=None):
+    def build_prompt(self, pinned, blocks):
+        return pinned + "".join(blocks)
+
+    def generate(self, prompt, options=None, seed=None, reject=None, on_text=None):
         return input()
@@ -5,7 +5,9 @@ import sys
 import time
 
 from generator.gpt2.gpt2_generator import *
+from generator.gpt2.remote_generator import RemoteGenerator
 from story import grammars
+from story.background import NAME_TOKEN, IdleWorker, NextPrompt, OpeningPool, RetryBuffer
 from story.story_manager import *
 from story.utils import *
 from playsound import playsound
@@ -19,6 +21,9 @@ from banners.bannerRan import *
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
+# Tokens generated for the first block of a new story
+OPENING_LENGTH = 120
+
 
 def splash():
     print("0) New Game\n1) Load Game\n")
@@ -130,7 +135,14 @@ def get_custom_prompt():
 def get_curated_exposition(
     setting_key, character_key, name, character, setting_description
 ):
-    name_token = "<NAME>"
+    context, prompt = get_exposition_template(
+        setting_key, character_key, character, setting_description
+    )
+    return context.replace(NAME_TOKEN, name), prompt.replace(NAME_TOKEN, name)
+
+
+def get_exposition_template(setting_key, character_key, character, setting_description):
+    """Context and prompt of a curated game with NAME_TOKEN for the player's name."""
     if (
         character_key == "noble"
         or character_key == "knight"
@@ -139,13 +151,11 @@ def get_curated_exposition(
         or character_key == "rogue"
     ):
         context = grammars.generate(setting_key, character_key, "context") + "\n\n"
-        context = context.replace(name_token, name)
         prompt = grammars.generate(setting_key, character_key, "prompt")
-        prompt = prompt.replace(name_token, name)
     else:
         context = (
             "You are "
-            + name
+            + NAME_TOKEN
             + ", a "
             + character_key
             + " "
@@ -199,6 +209,8 @@ def instructions():
     text += '\n  "/temp #.#"       Changes the AI\'s temperature'
     text += '\n                    (higher temperature = less focused). Default is 0.4.'
     text += '\n  "/top ##"         Changes the AI\'s top_p. Default is 0.9.'
+    text += '\n  "/candidates #"   Sample this many results at once and keep the best. Default is 1.'
+    text += '\n  "/openings #"     Keep this many openings ready for each character. Default is 2.'
     text += '\n  "/raw off/on"     Changes whether to feed the AI raw text instead of CYOA, interprets \\n as newline. (default off).'
     text += '\n  "/remember XXX"   Commit something important to the AI\'s memory for that session.'
     text += '\n  "/context"        Edit what your AI has currently committed to memory.'
@@ -215,10 +227,39 @@ def play_aidungeon_2():
     upload_story = True
     ping = False
     generator = None
+    if "AIDUNGEON_SERVER" in os.environ:
+        # Sample on a running inference server instead of loading the model here, for
+        # loaded games as well as new ones
+        generator = RemoteGenerator(os.environ["AIDUNGEON_SERVER"])
     autosave = False
     story_manager = UnconstrainedStoryManager(generator, upload_story=upload_story, cloud=False)
     print("\n")
 
+    # Openings of curated games are generated while the player is busy with menus or
+    # reading, so starting another game doesn't have to wait for one
+    with open(YAML_FILE, "r") as stream:
+        story_data = yaml.safe_load(stream)
+    idle_worker = IdleWorker(story_manager)
+    opening_pool = OpeningPool(
+        story_manager,
+        lambda setting_key, character_key: get_exposition_template(
+            setting_key,
+            character_key,
+            story_data["settings"][setting_key]["characters"][character_key],
+            story_data["settings"][setting_key]["description"],
+        ),
+        [
+            (setting_key, character_key)
+            for setting_key, setting in story_data["settings"].items()
+            for character_key in setting["characters"]
+        ],
+        OPENING_LENGTH,
+    )
+    # Results for /retry, generated while the player reads the last one
+    retry_buffer = RetryBuffer(story_manager)
+    # Keys/values of the next prompt up to the action, computed while it's typed
+    next_prompt = NextPrompt(story_manager)
+
     ranBanner =  bannerRan()
     openingPass = (ranBanner.banner_number)
 
@@ -232,11 +273,13 @@ def play_aidungeon_2():
 
         while story_manager.story is None:
             print("\n\n")
+            idle_worker.resume()
             splash_choice = splash()
 
             if splash_choice == "new":
                 print("\n\n")
                 is_custom, setting_key, character_key, name, character, setting_description = select_game()
+                idle_worker.pause()
                 if is_custom:
                     context, prompt = character, setting_description
                 else:
@@ -263,20 +306,29 @@ def play_aidungeon_2():
                 if change_config.lower() == "y":
                     story_manager.generator.change_temp(float(input("Enter a new temp (default 0.4): ") or 0.4))
                     story_manager.generator.change_top_p(float(input("Enter a new top_p (default 0.9): ") or 0.9))
-                    console_print("Please wait while the AI model is regenerated...")
-                    story_manager.generator.gen_output()
                 console_print(instructions())
-                print("\nGenerating story...")
-                story_manager.generator.generate_num = 120
-                story_manager.start_new_story(
-                    prompt, context=context, upload_story=upload_story
-                )
+                opening = None
+                if not is_custom:
+                    opening = opening_pool.take(setting_key, character_key, name)
+                    idle_worker.add(opening_pool.fill)
+                if opening is not None:
+                    context, prompt, block = opening
+                    story_manager.start_new_story(
+                        prompt, context=context, upload_story=upload_story, block=block
+                    )
+                else:
+                    print("\nGenerating story...")
+                    story_manager.generator.generate_num = OPENING_LENGTH
+                    story_manager.start_new_story(
+                        prompt, context=context, upload_story=upload_story
+                    )
                 print("\n")
                 console_print(str(story_manager.story))
                 story_manager.generator.generate_num = story_manager.generator.default_gen_num
 
             else:
                 load_ID = input("What is the ID of the saved game? (prefix with gs:// if it is a cloud save) ")
+                idle_worker.pause()
                 print("\nLoading Game...\n")
                 if load_ID.startswith("gs://"):
                     story_manager.cloud = True
@@ -300,11 +352,15 @@ def play_aidungeon_2():
                     console_print("File not found, or invalid password")
                     story_manager.set_encryption(None)
 
+        idle_worker.add(opening_pool.fill)
+        idle_worker.add(next_prompt.prefill, first=True)
         while True:
             if autosave and upload_story:
                 story_manager.save_story()
             sys.stdin.flush()
+            idle_worker.resume()
             action = input("\n> ").strip()
+            idle_worker.pause()
             if len(action) > 0 and action[0] == "/":
                 split = action[1:].split(" ")  # removes preceding slash
                 command = split[0].lower()
@@ -393,6 +449,8 @@ def play_aidungeon_2():
                     text += "\ncensor is set to:      " + str(story_manager.generator.censor)
                     text += "\ntemperature is set to: " + str(story_manager.generator.temp)
                     text += "\ntop_p is set to:       " + str(story_manager.generator.top_p)
+                    text += "\ncandidates is set to:  " + str(story_manager.generator.candidates)
+                    text += "\nopenings is set to:    " + str(opening_pool.size)
                     text += "\ncurrent model is:      " + story_manager.generator.model_name
                     text += "\nraw is set to:         " + str(story_manager.generator.raw)
                     print(text)
@@ -522,9 +580,7 @@ def play_aidungeon_2():
                         console_print("Failed to set temperature. Example usage: /temp 0.4")
                     else:
                         try:
-                            console_print("Regenerating model, please wait...")
                             story_manager.generator.change_temp(float(args[0]))
-                            story_manager.generator.gen_output()
                             console_print("Set temp to {}".format(story_manager.generator.temp))
                         except ValueError:
                             console_print("Failed to set temperature. Example usage: /temp 0.4")
@@ -536,14 +592,37 @@ def play_aidungeon_2():
                         console_print("Failed to set top_p. Example usage: /top 0.9")
                     else:
                         try:
-                            console_print("Regenerating model, please wait...")
                             story_manager.generator.change_top_p(float(args[0]))
-                            story_manager.generator.gen_output()
                             console_print("Set top_p to {}".format(story_manager.generator.top_p))
                         except ValueError:
                             console_print("Failed to set top_p. Example usage: /top 0.9")
                             continue
 
+                elif command == "candidates":
+
+                    if len(args) != 1:
+                        console_print("Failed to set candidates. Example usage: /candidates 4")
+                    else:
+                        try:
+                            story_manager.generator.candidates = max(1, int(args[0]))
+                            console_print("Set candidates to {}".format(story_manager.generator.candidates))
+                        except ValueError:
+                            console_print("Failed to set candidates. Example usage: /candidates 4")
+                            continue
+
+                elif command == "openings":
+
+                    if len(args) != 1:
+                        console_print("Failed to set openings. Example usage: /openings 2")
+                    else:
+                        try:
+                            opening_pool.size = max(0, int(args[0]))
+                            idle_worker.add(opening_pool.fill)
+                            console_print("Set openings to {}".format(opening_pool.size))
+                        except ValueError:
+                            console_print("Failed to set openings. Example usage: /openings 2")
+                            continue
+
                 elif command == "raw":
                     if len(args) == 0:
                         console_print("Raw input is " + ("enabled." if story_manager.generator.raw else "disabled."))
@@ -571,10 +650,14 @@ def play_aidungeon_2():
 
                 elif command == 'retry':
                     if len(story_manager.story.actions) > 0:
+                        alternative = retry_buffer.take()
                         last_action = story_manager.story.actions.pop()
                         last_result = story_manager.story.results.pop()
                         try:
-                            story_manager.act_with_timeout(last_action)
+                            if alternative is not None:
+                                story_manager.story.add_to_story(last_action, alternative)
+                            else:
+                                story_manager.act_with_timeout(last_action)
                             console_print(last_action)
                             console_print(story_manager.story.results[-1])
                         except FunctionTimedOut:
@@ -584,6 +667,8 @@ def play_aidungeon_2():
                         finally:
                             if ping:
                                 playsound('ping.mp3')
+                        idle_worker.add(retry_buffer.fill, first=True)
+                        idle_worker.add(next_prompt.prefill, first=True)
                     else:
                         # Retry for another story start
                         block = story_manager.generator.generate(story_manager.story.context + story_manager.story.story_prompt)
@@ -684,9 +769,14 @@ def play_aidungeon_2():
                 else:
                     action = action.replace("\\n", "\n")
 
+                # The result is printed while it is generated
+                stream = ConsoleStream()
+                stream.write("\n")
                 try:
-                    result = "\n" + story_manager.act_with_timeout(action)
+                    result = "\n" + story_manager.act_with_timeout(action, on_text=stream.write)
+                    print()
                 except FunctionTimedOut:
+                    print()
                     console_print("That input caused the model to hang (timeout is {}, use infto ## command to change)".format(story_manager.inference_timeout))
                     if ping:
                         playsound('ping.mp3')
@@ -704,9 +794,12 @@ def play_aidungeon_2():
                         if ping:
                             playsound('ping.mp3')
                         continue
+                # The next prompt is needed first, so it's prefilled before the retries
+                idle_worker.add(retry_buffer.fill, first=True)
+                idle_worker.add(next_prompt.prefill, first=True)
 
                 if player_won(result):
-                    console_print(result + "\n CONGRATS YOU WIN")
+                    console_print(" CONGRATS YOU WIN")
                     console_print("\nOptions:")
                     console_print("0) Start a new game")
                     console_print(
@@ -722,7 +815,7 @@ def play_aidungeon_2():
                         console_print(result)
 
                 elif player_died(result):
-                    console_print(result + "\n YOU DIED. GAME OVER")
+                    console_print(" YOU DIED. GAME OVER")
                     console_print("\nOptions:")
                     console_print("0) Start a new game")
                     console_print(
@@ -737,8 +830,6 @@ def play_aidungeon_2():
                         console_print("Sorry about that...where were we?")
                         console_print(result)
 
-                else:
-                    console_print(result)
                 if ping:
                     playsound('ping.mp3')
                 story_manager.generator.generate_num = story_manager.generator.default_gen_num
@@ -0,0 +1,213 @@
+import re
+import threading
+from collections import deque
+
+NAME_TOKEN = "<NAME>"
+
+
+def generation_settings(generator):
+    """What text generated ahead of time has to have been generated with.
+
+    Includes censor since the text has already been through result_replace.
+    """
+    return (
+        generator.model_name,
+        generator.temp,
+        generator.top_p,
+        generator.raw,
+        generator.censor,
+    )
+
+
+class IdleWorker:
+    """Uses the model in a background thread while the player is reading or typing.
+
+    Tasks are callables that return True while they have more to do. They only run
+    between resume() and pause(), so they never use the generator at the same time as
+    the game. pause() stops a running task by expiring the generator's deadline, which
+    the numpy backend checks every token and TensorFlow every backend call; the
+    TimeoutError that causes leaves the task queued to start over next time.
+    """
+
+    def __init__(self, story_manager):
+        self.story_manager = story_manager
+        self.tasks = deque()
+        self.idle = False
+        self.running = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, task, first=False):
+        """Queue task, or move it to the front of the queue if first."""
+        with self.condition:
+            if first:
+                if task in self.tasks:
+                    self.tasks.remove(task)
+                self.tasks.appendleft(task)
+            elif task not in self.tasks:
+                self.tasks.append(task)
+            self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            self.idle = True
+            self.condition.notify_all()
+
+    def pause(self):
+        """Stop running tasks, waiting for the one that's running to stop."""
+        with self.condition:
+            self.idle = False
+            if self.running:
+                self.story_manager.generator.deadline = 0
+            while self.running:
+                self.condition.wait()
+            if self.story_manager.generator is not None:
+                self.story_manager.generator.deadline = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (
+                    self.idle
+                    and len(self.tasks) > 0
+                    and self.story_manager.generator is not None
+                ):
+                    self.condition.wait()
+                task = self.tasks[0]
+                self.running = True
+            try:
+                more = task()
+            except TimeoutError:
+                more = True
+            except Exception:
+                # Background work is only ever an optimization
+                more = False
+            with self.condition:
+                self.running = False
+                if not more and task in self.tasks:
+                    self.tasks.remove(task)
+                self.condition.notify_all()
+
+
+class OpeningPool:
+    """First story blocks of curated games, generated before anyone asks for them.
+
+    Up to size openings are kept per (setting, character). template(setting_key,
+    character_key) gives the context and prompt of a new game with NAME_TOKEN for the
+    player's name; openings are generated with the last name a player used in its
+    place and stored with it swapped back, so take() can fill in any name.
+    """
+
+    def __init__(self, story_manager, template, keys, length, size=2):
+        self.story_manager = story_manager
+        self.template = template
+        self.length = length
+        self.size = size
+        self.openings = {key: deque() for key in keys}
+        self.name = "Alex"
+
+    def fill(self):
+        """Generate one opening for the character with the fewest; an IdleWorker task."""
+        settings = generation_settings(self.story_manager.generator)
+        for openings in self.openings.values():
+            for opening in list(openings):
+                if opening[0] != settings:
+                    openings.remove(opening)
+        key = min(self.openings, key=lambda key: len(self.openings[key]))
+        if len(self.openings[key]) >= self.size:
+            return False
+
+        context, prompt = self.template(*key)
+        name = self.name
+        generator = self.story_manager.generator
+        generate_num = generator.generate_num
+        generator.generate_num = self.length
+        try:
+            # Streamed (with one candidate), so IdleWorker.pause can stop it between backend calls
+            block = generator.generate(
+                (context + prompt).replace(NAME_TOKEN, name), on_text=lambda text: None
+            )
+        finally:
+            generator.generate_num = generate_num
+        block = re.sub(r"\b" + re.escape(name) + r"\b", NAME_TOKEN, block)
+        self.openings[key].append((settings, context, prompt, block))
+        return True
+
+    def take(self, setting_key, character_key, name):
+        """A ready (context, prompt, block) for a game with this name, or None."""
+        self.name = name
+        openings = self.openings.get((setting_key, character_key), deque())
+        settings = generation_settings(self.story_manager.generator)
+        while len(openings) > 0:
+            opening = openings.popleft()
+            if opening[0] == settings:
+                return tuple(text.replace(NAME_TOKEN, name) for text in opening[1:])
+        return None
+
+
+class RetryBuffer:
+    """Other results for the last action, generated while the player reads the first.
+
+    /retry takes them in turn instead of generating one. They are sampled as one batch
+    from the prompt the last result came from, whose keys/values are still in the
+    generator's prefix cache, streamed so pause() stops it within stream_chunk tokens.
+    They only apply while that prompt and the generation settings stay the same; a
+    new action or an edit to the story throws them away.
+    """
+
+    def __init__(self, story_manager, size=3):
+        self.story_manager = story_manager
+        self.size = size
+        # Settings and prompt the buffered results were generated with
+        self.key = None
+        self.results = deque()
+
+    def current_key(self):
+        story_manager = self.story_manager
+        if story_manager.story is None or len(story_manager.story.actions) == 0:
+            return None
+        generator = story_manager.generator
+        # generate_num sets the result's length and how much of the story the prompt has
+        return (
+            generation_settings(generator),
+            generator.generate_num,
+            story_manager.retry_prompt(),
+        )
+
+    def fill(self):
+        """Generate alternatives once the buffer is empty; an IdleWorker task."""
+        key = self.current_key()
+        if key != self.key:
+            self.key = key
+            self.results.clear()
+        if key is None or len(self.results) > 0:
+            return False
+        self.results.extend(self.story_manager.generate_alternatives(key[-1], self.size))
+        return False
+
+    def take(self):
+        """The next buffered result for the last action, or None."""
+        if self.current_key() != self.key:
+            self.key = None
+            self.results.clear()
+        if len(self.results) == 0:
+            return None
+        return self.results.popleft()
+
+
+class NextPrompt:
+    """Prefills the start of the next prompt while the player types the action.
+
+    Everything before the action is already known once a result is shown, so its
+    keys/values can go in the prefix cache before it's needed and the turn itself
+    only runs the model over the action.
+    """
+
+    def __init__(self, story_manager):
+        self.story_manager = story_manager
+
+    def prefill(self):
+        """An IdleWorker task."""
+        if self.story_manager.story is not None:
+            self.story_manager.generator.prefill(self.story_manager.next_prompt_start())
+        return False
@@ -1,6 +1,7 @@
 import json
 import os
 import subprocess
+import time
 import uuid
 import copy
 from subprocess import Popen
@@ -69,19 +70,25 @@ class Story:
         self.actions.append(action)
         self.results.append(story_block)
 
-    def latest_result(self):
-        mem_ind = self.memory
+    def context_blocks(self):
+        """The text the AI always sees, and the latest actions and results after it.
+
+        Blocks are ordered oldest first; generators drop from the front when they
+        run out of room.
+        """
         if len(self.results) < 5:
-            latest_result = self.story_start
+            pinned = self.story_start
         else:
-            latest_result = self.context
-        while mem_ind > 0:
+            pinned = self.context
+        blocks = []
+        for i in range(max(len(self.results) - self.memory, 0), len(self.results)):
+            blocks.append(self.actions[i])
+            blocks.append(self.results[i])
+        return pinned, blocks
 
-            if len(self.results) >= mem_ind:
-                latest_result += self.actions[-mem_ind] + self.results[-mem_ind]
-
-            mem_ind -= 1
-        return latest_result
+    def latest_result(self):
+        pinned, blocks = self.context_blocks()
+        return pinned + "".join(blocks)
 
     def __str__(self):
         story_list = [self.story_start]
@@ -133,10 +140,12 @@ class StoryManager:
         atexit.register(self.print_save)
 
     def start_new_story(
-        self, story_prompt, context="", game_state=None, upload_story=False
+        self, story_prompt, context="", game_state=None, upload_story=False, block=None
     ):
+        """Start a story, generating its first block unless one is given."""
         self.upload_story = upload_story
-        block = self.generator.generate(context + story_prompt)
+        if block is None:
+            block = self.generator.generate(context + story_prompt)
         block = cut_trailing_sentence(block)
         self.story = Story(
             context + story_prompt + block,
@@ -189,7 +198,6 @@ class StoryManager:
                     game = json.load(fp)
             self.story = Story("")
             self.story.init_from_dict(game)
-            changed = False
             if "model" in game.keys():
                 if self.generator is not None:
                     if self.generator.model_name != game["model"]:
@@ -205,14 +213,11 @@ class StoryManager:
                 if self.generator is None:
                     self.generator = GPT2Generator()
             if "top_p" in game.keys():
-                changed = changed or self.generator.change_top_p(game["top_p"])
+                self.generator.change_top_p(game["top_p"])
             if "temp" in game.keys():
-                changed = changed or self.generator.change_temp(game["temp"])
+                self.generator.change_temp(game["temp"])
             if "raw" in game.keys():
                 self.generator.change_raw(game["raw"])
-            if changed:
-                console_print("Please wait while the AI model is regenerated...")
-                self.generator.gen_output()
             return str(self.story)
         else:
             return None
@@ -284,9 +289,32 @@ class StoryManager:
     def story_context(self):
         return self.story.latest_result()
 
+    def with_deadline(self, function, *args):
+        """Call function, stopping generation after inference_timeout seconds.
+
+        The generator checks the deadline itself and stops sampling, so unlike
+        func_timeout nothing keeps running in the background after the timeout.
+        Raises FunctionTimedOut like func_timeout did.
+        """
+        self.generator.deadline = time.time() + self.inference_timeout
+        try:
+            return function(*args)
+        except TimeoutError:
+            raise FunctionTimedOut(
+                timedOutAfter=self.inference_timeout,
+                timedOutFunction=function,
+                timedOutArgs=args,
+            )
+        finally:
+            self.generator.deadline = None
+
+    def is_looping(self, result):
+        # Same check play.py applies after a turn, used to pick between candidates
+        return len(self.story.results) > 0 and get_similarity(result, self.story.results[-1]) > 0.9
+
 
 class UnconstrainedStoryManager(StoryManager):
-    def act(self, action_choice):
+    def act(self, action_choice, on_text=None):
         if self.generator.raw:
             if len(action_choice) > 0:
                 if not action_choice[-1].isspace():
@@ -295,19 +323,49 @@ class UnconstrainedStoryManager(StoryManager):
                     action_choice = " " + action_choice
             else:
                 action_choice = " "
-        result = self.generate_result(action_choice)
+        result = self.generate_result(action_choice, on_text)
         self.story.add_to_story(action_choice, result)
         return result
 
-    def act_with_timeout(self, action_choice):
-        return func_timeout(self.inference_timeout, self.act, (action_choice,))
+    def act_with_timeout(self, action_choice, on_text=None):
+        return self.with_deadline(self.act, action_choice, on_text)
 
-    def generate_result(self, action):
-        block = self.generator.generate(self.story_context() + action)
+    def generate_result(self, action, on_text=None):
+        pinned, blocks = self.story.context_blocks()
+        prompt = self.generator.build_prompt(pinned, blocks + [action])
+        block = self.generator.generate(prompt, reject=self.is_looping, on_text=on_text)
         return block
 
     def generate_with_timeout(self, action):
-        return func_timeout(self.inference_timeout, self.generate_result, (action,))
+        return self.with_deadline(self.generate_result, action)
+
+    def retry_prompt(self):
+        """The prompt the result of the last action was generated from."""
+        story = copy.copy(self.story)
+        story.actions = self.story.actions[:-1]
+        story.results = self.story.results[:-1]
+        pinned, blocks = story.context_blocks()
+        return self.generator.build_prompt(pinned, blocks + self.story.actions[-1:])
+
+    def next_prompt_start(self):
+        """The part of the next action's prompt that doesn't depend on the action.
+
+        Older blocks are dropped to make room for the action as if it were as long as
+        the last one.
+        """
+        pinned, blocks = self.story.context_blocks()
+        guess = self.story.actions[-1] if len(self.story.actions) > 0 else ""
+        prompt = self.generator.build_prompt(pinned, blocks + [guess])
+        return prompt[: len(prompt) - len(guess)]
+
+    def generate_alternatives(self, prompt, count):
+        """Other results for the last action, from its retry_prompt."""
+        results = self.story.results
+
+        def is_looping(result):
+            return len(results) >= 2 and get_similarity(result, results[-2]) > 0.9
+
+        return self.generator.generate_many(prompt, count, reject=is_looping)
 
     def set_context(self, context):
         self.story.context = context
@@ -30,6 +30,27 @@ def console_print(text, width=75):
     print(text)
 
 
+class ConsoleStream:
+    """Prints text as it arrives, wrapping lines the same way as console_print."""
+
+    def __init__(self, width=75):
+        self.width = width
+        self.last_newline = 0
+
+    def write(self, text):
+        out = []
+        for c in text:
+            if c == "\n":
+                self.last_newline = 0
+            elif self.last_newline > self.width and c == " ":
+                out.append("\n")
+                self.last_newline = 1
+            else:
+                self.last_newline += 1
+            out.append(c)
+        print("".join(out), end="", flush=True)
+
+
 def get_similarity(a, b):
     return SequenceMatcher(None, a, b).ratio()
 
@@ -0,0 +1,103 @@
+"""Run from the repository root: python -m unittest discover tests"""
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+import numpy as np
+from generator.gpt2.inference_server import InferenceServer
+from generator.gpt2.np_backend import NumpyBackend
+from generator.gpt2.prefix_cache import PrefixCache
+from generator.gpt2.src import np_model, weights
+
+
+def random_generator(path, n_vocab=64, n_ctx=256, n_embd=16):
+    """What the scheduler uses of a GPT2Generator, on a random one layer model."""
+    hparams = np_model.default_hparams()
+    hparams.override_from_dict(
+        dict(n_vocab=n_vocab, n_ctx=n_ctx, n_embd=n_embd, n_head=2, n_layer=1)
+    )
+    rng = np.random.RandomState(0)
+    arrays = {
+        "model/wte": rng.randn(n_vocab, n_embd),
+        "model/wpe": rng.randn(n_ctx, n_embd),
+        "model/ln_f/g": np.ones(n_embd),
+        "model/ln_f/b": np.zeros(n_embd),
+    }
+    for name, shape in (
+        ("attn/c_attn", (n_embd, 3 * n_embd)),
+        ("attn/c_proj", (n_embd, n_embd)),
+        ("mlp/c_fc", (n_embd, 4 * n_embd)),
+        ("mlp/c_proj", (4 * n_embd, n_embd)),
+    ):
+        arrays["model/h0/" + name + "/w"] = rng.randn(1, *shape) * 0.2
+        arrays["model/h0/" + name + "/b"] = np.zeros(shape[1])
+    for name in ("ln_1", "ln_2"):
+        arrays["model/h0/" + name + "/g"] = np.ones(n_embd)
+        arrays["model/h0/" + name + "/b"] = np.zeros(n_embd)
+    arrays = {name: array.astype(np.float32) for name, array in arrays.items()}
+    weights.save(os.path.join(path, weights.WEIGHTS_FILE), arrays)
+
+    # Nothing stops sampling early, so requests run their full length
+    never = np.zeros(n_vocab, dtype=bool)
+    return types.SimpleNamespace(
+        hparams=hparams,
+        backend=NumpyBackend(
+            hparams, path, sentence_tokens=never, end_token=n_vocab - 1
+        ),
+        prefix_cache=PrefixCache(),
+        stream_chunk=1,
+        end_token=n_vocab - 1,
+        penalty=0.85,
+        penalty_window=0,
+        nucleus_candidates=0,
+        stop_tokens=never,
+        raw_stop_tokens=never,
+        sentence_tokens=never,
+    )
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class DisconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = InferenceServer(("localhost", 0), random_generator(self.path))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_closed_connection_leaves_the_batch(self):
+        scheduler = self.server.scheduler
+        connection = socket.create_connection(self.server.server_address)
+        message = {"context": [1, 2, 3], "length": 250, "candidates": 4}
+        connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        with connection.makefile("r", encoding="utf-8") as replies:
+            reply = json.loads(replies.readline())
+        self.assertEqual(len(reply["tokens"]), 4)
+        self.assertTrue(wait_for(lambda: len(scheduler.rows) == 4))
+        connection.close()
+
+        self.assertTrue(wait_for(lambda: len(scheduler.rows) == 0))
+        # A request that ran to the end would have been recorded
+        self.assertEqual(scheduler.stats.summary()["requests"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()